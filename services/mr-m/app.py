@@ -8,7 +8,7 @@ from flask_cors import CORS  # keep if you use it
 from dotenv import load_dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from libs.search import get_faiss_index, load_metadata_pickle, query_index, build_rag_query
+from libs.search import get_faiss_index, faiss_build_info, load_columns, query_index, build_rag_query
 from libs.analytics import log_visit, load_analytics_data, summarize_analytics
 from libs.ratelimiter import check_and_increment_ip, get_ip_quota
 from libs.challenge import is_trusted, mark_trusted, burst_ok, verify_challenge
@@ -79,9 +79,12 @@ def load_vector_store():
     faiss_index_path = data_dir / "faiss.index"
     chunks_path = data_dir / "metadata.pkl"
     index = get_faiss_index(faiss_index_path)
-    metadata = load_metadata_pickle(chunks_path)
+    metadata = load_columns(chunks_path)  # metadata.arrow when present
+    if index.ntotal != len(metadata["text"]):
+        # written by different embedding runs: every hit would map to the wrong chunk
+        raise RuntimeError(f"FAISS index has {index.ntotal} vectors but metadata has {len(metadata['text'])} rows")
     try:
-        print(f"✅ FAISS index loaded with {index.ntotal} vectors")
+        print(f"✅ FAISS index loaded with {index.ntotal} vectors ({faiss_build_info()})")
     except Exception:
         pass
     return index, metadata
@@ -164,7 +167,7 @@ def chat():
         index, metadata = load_vector_store()
         rag_query = build_rag_query(history, message, max_tokens=2500)
         relevant_chunks = query_index(rag_query, index, metadata, top_k=5)
-        context = "\n\n".join([f"Source: {c['source_path']}\n{c['text']}" for c in relevant_chunks])
+        context = "\n\n".join([f"Source: {source}\n{text}" for source, text in relevant_chunks])
 
         # 4) Build messages
         system_prompt = {
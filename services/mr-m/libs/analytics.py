@@ -1,13 +1,16 @@
-import os, json, re
+import os, json, re, atexit
 from pathlib import Path
 from datetime import timedelta, datetime, timezone
-from collections import defaultdict
+from collections import Counter
 from typing import Dict, Any, List
 from flask import request, has_request_context
 from urllib.parse import urlparse
 from filelock import FileLock
-from threading import Lock
+from threading import Lock, Thread
+from functools import lru_cache
+from queue import Queue, Full, Empty
 import requests
+from requests.adapters import HTTPAdapter
 
 # --- optional S3 backend ---
 S3_BUCKET = os.getenv("ANALYTICS_S3_BUCKET")
@@ -24,17 +27,48 @@ file_mutex = Lock()
 
 RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "30"))
 
+# local backend: one JSON object per line, appended per visit; pruned at most once a day
+LOG_FILE_NAME = "visits.jsonl"
+LEGACY_LOG_FILE_NAME = "visits.json"
+_last_prune_day = None
+
+# geolocation runs on a background thread so page views don't wait on ipapi.co;
+# off on Lambda, where threads are frozen between invocations
+_on_lambda = os.getenv("AWS_EXECUTION_ENV", "").startswith("AWS_Lambda_")
+ASYNC_GEO = os.getenv("ANALYTICS_ASYNC_GEO", "0" if _on_lambda else "1") == "1"
+# bounded: with a slow geo API a burst can't pile up visits in memory; overflow is written without geo
+GEO_QUEUE_MAX = int(os.getenv("ANALYTICS_GEO_QUEUE_MAX", "1000"))
+_geo_queue: Queue = Queue(maxsize=GEO_QUEUE_MAX)
+_geo_worker = None
+_geo_worker_lock = Lock()
+
 def _now_utc():
     return datetime.now(timezone.utc)
 
 def _cutoff():
     return _now_utc() - timedelta(days=RETENTION_DAYS)
 
-def _is_recent_timestamp(ts: str) -> bool:
-    try:
-        return datetime.fromisoformat(ts.replace("Z", "+00:00")) >= _cutoff()
-    except Exception:
-        return False
+def _parse_ts(ts: str):
+    if ts.endswith("Z"):
+        ts = ts[:-1] + "+00:00"
+    return datetime.fromisoformat(ts)
+
+def _recent_filter():
+    """Predicate for "timestamp is inside the retention window", with the cutoff fixed once."""
+    cutoff = _cutoff()
+    cutoff_iso = cutoff.isoformat()
+
+    def is_recent(ts: str) -> bool:
+        # entries we write are UTC isoformat(); equal-length strings in that format
+        # sort chronologically, so compare them as strings and skip the parse
+        if len(ts) == len(cutoff_iso) and ts.endswith("+00:00"):
+            return ts >= cutoff_iso
+        try:
+            return _parse_ts(ts) >= cutoff
+        except Exception:
+            return False
+
+    return is_recent
 
 def _default_log_dir() -> Path:
 
@@ -48,6 +82,58 @@ def _default_log_dir() -> Path:
     
     return Path(__file__).resolve().parent.parent / "data" / "analytics"
 
+def _log_paths(log_dir: Path = None):
+    log_dir = log_dir or _default_log_dir()
+    log_file = log_dir / LOG_FILE_NAME
+    return log_dir, log_file, log_file.with_suffix(".lock")
+
+def _iter_log(log_file: Path):
+    """Yield entries from a JSONL log, skipping torn/corrupt lines."""
+    with log_file.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def _migrate_legacy(log_dir: Path, log_file: Path) -> None:
+    """One-off conversion of the old whole-file visits.json into JSONL. Call under the lock.
+
+    Once the JSONL log is in place the old file is renamed to visits.json.migrated,
+    so it is neither converted again nor left looking like the live log.
+    """
+    legacy = log_dir / LEGACY_LOG_FILE_NAME
+    if not legacy.exists():
+        return
+    if not log_file.exists():
+        try:
+            content = legacy.read_text(encoding="utf-8").strip()
+            logs = json.loads(content) if content else []
+        except json.JSONDecodeError:
+            print(f"⚠️ {legacy} is not valid JSON; starting a fresh visit log")
+            logs = []
+        tmp = log_file.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for e in logs:
+                f.write(json.dumps(e) + "\n")
+        os.replace(tmp, log_file)
+    legacy.replace(legacy.with_name(legacy.name + ".migrated"))
+
+def _prune_log(log_file: Path) -> None:
+    """Rewrite the log without expired entries. Call under the lock."""
+    if not log_file.exists():
+        return
+    is_recent = _recent_filter()
+    kept = [e for e in _iter_log(log_file) if is_recent(e.get("timestamp", ""))]
+    tmp = log_file.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        for e in kept:
+            f.write(json.dumps(e) + "\n")
+    os.replace(tmp, log_file)
+
 def _s3_load() -> List[Dict[str, Any]]:
     if not (S3_BUCKET and _s3):
         return None
@@ -69,176 +155,243 @@ def _s3_save(data: List[Dict[str, Any]]) -> None:
         ContentType="application/json",
     )
 
+TAB_NAME_MAP = {
+    "/": "Home",
+    "/about": "About Me",
+    "/projects": "Projects",
+    "/research": "Research",
+    "/talks": "Talks",
+    "/ask-mr-m": "Ask Mr M",
+    "/analytics": "Analytics",
+    "/contact": "Contact",
+}
+_HOME_ALIASES = frozenset({"/index.html", "/home"})
+
+_MOBILE_RE = re.compile(r"mobile|android|iphone", re.IGNORECASE)
+_TABLET_RE = re.compile(r"ipad|tablet", re.IGNORECASE)
+_IPV6_TAIL_RE = re.compile(r'(:[^:]+){2}$')
+
+@lru_cache(maxsize=4096)
 def parse_device(user_agent: str) -> str:
     if not user_agent:
         return "Unknown"
-    ua = user_agent.lower()
-    if "mobile" in ua or "android" in ua or "iphone" in ua:
+    if _MOBILE_RE.search(user_agent):
         return "Mobile"
-    if "ipad" in ua or "tablet" in ua:
+    if _TABLET_RE.search(user_agent):
         return "Tablet"
     return "Desktop"
 
+@lru_cache(maxsize=4096)
 def anonymize_ip(ip: str) -> str:
     if ":" in ip:
-        return re.sub(r'(:[^:]+){2}$', '::****', ip)
+        return _IPV6_TAIL_RE.sub('::****', ip)
     parts = ip.split('.')
     return '.'.join(parts[:2]) + '.***.***' if len(parts) == 4 else ip
 
+@lru_cache(maxsize=1)
+def _geo_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=32)
+    session.mount("https://", adapter)
+    return session
+
+@lru_cache(maxsize=4096)
+def _lookup_geo(ip: str) -> tuple:
+    # raises on failure so errors are not cached
+    resp = _geo_session().get(f"https://ipapi.co/{ip}/json/", timeout=3)
+    resp.raise_for_status()
+    geo = resp.json()
+    return geo.get("country_name", "Unknown"), geo.get("latitude"), geo.get("longitude"), geo.get("proxy", False)
+
+def _geolocate(ip: str) -> tuple:
+    if ip.startswith("127.") or ip == "localhost":
+        return "Local", None, None, False
+    try:
+        return _lookup_geo(ip)
+    except Exception:
+        return "Unknown", None, None, False
+
+def _fill_geo(entry: Dict[str, Any]) -> Dict[str, Any]:
+    entry["country"], entry["latitude"], entry["longitude"], entry["proxy"] = _geolocate(entry["ip"])
+    return entry
+
+def _without_geo(entry: Dict[str, Any]) -> Dict[str, Any]:
+    # same shape as a failed lookup
+    entry["country"] = "Unknown"
+    return entry
+
+def _geo_loop() -> None:
+    while True:
+        entry, log_dir = _geo_queue.get()
+        try:
+            _write_entry(_fill_geo(entry), log_dir)
+        except Exception as e:
+            print(f"⚠️ Failed to write visit: {e}")
+        finally:
+            _geo_queue.task_done()
+
+def _flush_geo_queue() -> None:
+    """At exit, write visits the daemon worker never got to (without geo) instead of dropping them."""
+    written = 0
+    while True:
+        try:
+            entry, log_dir = _geo_queue.get_nowait()
+        except Empty:
+            break
+        try:
+            _write_entry(_without_geo(entry), log_dir)
+            written += 1
+        except Exception as e:
+            print(f"⚠️ Failed to write visit: {e}")
+        finally:
+            _geo_queue.task_done()
+    if written:
+        print(f"⚠️ Wrote {written} queued visits without geolocation at shutdown")
+
+def _enqueue(entry: Dict[str, Any], log_dir: Path) -> None:
+    global _geo_worker
+    with _geo_worker_lock:
+        if _geo_worker is None or not _geo_worker.is_alive():
+            if _geo_worker is None:
+                atexit.register(_flush_geo_queue)
+            _geo_worker = Thread(target=_geo_loop, name="analytics-geo", daemon=True)
+            _geo_worker.start()
+    try:
+        _geo_queue.put_nowait((entry, log_dir))
+    except Full:
+        # worker is backed up on the geo API: keep the visit, skip the lookup
+        _write_entry(_without_geo(entry), log_dir)
+
 def log_visit(log_dir: Path = None) -> None:
     if not has_request_context():
         return
 
-    # where to store if S3 is NOT configured
-    log_dir = log_dir or _default_log_dir()
-    log_file = log_dir / "visits.json"
-    lock_file = log_file.with_suffix(".lock")
-    log_dir.mkdir(parents=True, exist_ok=True)
-
-    TAB_NAME_MAP = {
-        "/": "Home",
-        "/about": "About Me",
-        "/projects": "Projects",
-        "/research": "Research",
-        "/talks": "Talks",
-        "/ask-mr-m": "Ask Mr M",
-        "/analytics": "Analytics",
-        "/contact": "Contact",
-    }
-
     referer = request.headers.get("Referer", "")
     parsed = urlparse(referer)
     ref_path = parsed.path
     path = ref_path if ref_path else request.path or "/"
-    if path in ["/index.html", "/home"]:
+    if path in _HOME_ALIASES:
         path = "/"
-    if path not in TAB_NAME_MAP:
+    tab_name = TAB_NAME_MAP.get(path)
+    if tab_name is None:
         return
-    tab_name = TAB_NAME_MAP[path]
 
     ip_raw = request.headers.get("X-Forwarded-For", request.remote_addr)
     user_agent = request.headers.get("User-Agent", "")
     device = parse_device(user_agent)
 
-    if ip_raw.startswith("127.") or ip_raw == "localhost":
-        country, latitude, longitude, proxy = "Local", None, None, False
-    else:
-        try:
-            geo = requests.get(f"https://ipapi.co/{ip_raw}/json/").json()
-            country = geo.get("country_name", "Unknown")
-            latitude = geo.get("latitude")
-            longitude = geo.get("longitude")
-            proxy = geo.get("proxy", False)
-        except Exception:
-            country, latitude, longitude, proxy = "Unknown", None, None, False
-
     log_entry = {
         "ip": ip_raw,
-        "country": country,
+        "country": None,
         "device": device,
         "user_agent": user_agent,
         "timestamp": _now_utc().isoformat(),
-        "proxy": proxy,
-        "latitude": latitude,
-        "longitude": longitude,
+        "proxy": False,
+        "latitude": None,
+        "longitude": None,
         "path": path,
         "tab": tab_name,
     }
 
+    if ASYNC_GEO:
+        _enqueue(log_entry, log_dir)
+    else:
+        _write_entry(_fill_geo(log_entry), log_dir)
+
+def _write_entry(log_entry: Dict[str, Any], log_dir: Path = None) -> None:
     # --- Load, append, prune, save ---
     # Prefer S3 if configured; else local file with lock
     if S3_BUCKET and _s3:
         logs = _s3_load() or []
         logs.append(log_entry)
-        logs = [e for e in logs if _is_recent_timestamp(e.get("timestamp", ""))]
+        is_recent = _recent_filter()
+        logs = [e for e in logs if is_recent(e.get("timestamp", ""))]
         _s3_save(logs)
     else:
-        logs: List[Dict[str, Any]] = []
+        # where to store if S3 is NOT configured
+        log_dir, log_file, lock_file = _log_paths(log_dir)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        # append one line instead of rewriting the whole file; retention runs once a day
+        global _last_prune_day
+        today = _now_utc().date()
         with file_mutex:
             with FileLock(lock_file):
-                if log_file.exists():
-                    try:
-                        with log_file.open("r", encoding="utf-8") as f:
-                            content = f.read().strip()
-                            if content:
-                                logs = json.loads(content)
-                    except json.JSONDecodeError:
-                        logs = []
-                logs.append(log_entry)
-                logs = [e for e in logs if _is_recent_timestamp(e.get("timestamp", ""))]
-                with log_file.open("w", encoding="utf-8") as f:
-                    json.dump(logs, f, indent=2)
+                _migrate_legacy(log_dir, log_file)
+                if _last_prune_day != today:
+                    _prune_log(log_file)
+                    _last_prune_day = today
+                with log_file.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(log_entry) + "\n")
+                    f.flush()
 
 def load_analytics_data(log_dir: Path = None) -> List[Dict[str, Any]]:
     if S3_BUCKET and _s3:
         return _s3_load() or []
-    log_dir = log_dir or _default_log_dir()
-    log_file = log_dir / "visits.json"
-    lock_file = log_file.with_suffix(".lock")
-    if not log_file.exists():
+    log_dir, log_file, lock_file = _log_paths(log_dir)
+    if not log_file.exists() and not (log_dir / LEGACY_LOG_FILE_NAME).exists():
         return []
     with file_mutex:
         with FileLock(lock_file):
-            try:
-                with log_file.open("r", encoding="utf-8") as f:
-                    content = f.read().strip()
-                    return json.loads(content) if content else []
-            except json.JSONDecodeError:
+            _migrate_legacy(log_dir, log_file)
+            if not log_file.exists():
                 return []
+            return list(_iter_log(log_file))
 
-def summarize_analytics(log_dir: Path = None) -> Dict[str, Any]:
-    visits = load_analytics_data(log_dir)
-    # prune again using moving window (in case the file contains older data)
-    visits = [v for v in visits if _is_recent_timestamp(v.get("timestamp",""))]
+def _iter_visits(log_dir: Path = None):
+    """Stream visits without materializing the whole log (S3 still loads its single object)."""
+    if S3_BUCKET and _s3:
+        yield from _s3_load() or []
+        return
+    log_dir, log_file, lock_file = _log_paths(log_dir)
+    if not log_file.exists():
+        if not (log_dir / LEGACY_LOG_FILE_NAME).exists():
+            return
+        with file_mutex:
+            with FileLock(lock_file):
+                _migrate_legacy(log_dir, log_file)
+    # no lock needed: appends are line-sized and pruning swaps the file with os.replace
+    yield from _iter_log(log_file)
 
-    by_country = defaultdict(int)
-    by_device = defaultdict(int)
-    by_ip = defaultdict(int)
-    by_day = defaultdict(int)
-    by_path = defaultdict(int)
-    by_tab = defaultdict(int)
+def summarize_analytics(log_dir: Path = None) -> Dict[str, Any]:
+    is_recent = _recent_filter()
 
+    # gather columns in one pass, then count each with Counter (its counting loop runs in C)
+    countries, devices, ips, days, paths, tabs = [], [], [], [], [], []
     vpn_count = 0
-    unknown_country_count = 0
-
-    for visit in visits:
-        country = visit.get("country", "Unknown")
-        device = visit.get("device", "Unknown")
-        ip = visit.get("ip", "Unknown")
-        path = visit.get("path", "Unknown")
-        tab = visit.get("tab", "Unknown")
-
-        by_country[country] += 1
-        by_device[device] += 1
-        by_ip[ip] += 1
-        by_path[path] += 1
-        by_tab[tab] += 1
-
-        if country == "Unknown":
-            unknown_country_count += 1
+
+    for visit in _iter_visits(log_dir):
+        # prune again using moving window (in case the file contains older data)
+        ts = visit.get("timestamp", "")
+        if not is_recent(ts):
+            continue
+
+        countries.append(visit.get("country", "Unknown"))
+        devices.append(visit.get("device", "Unknown"))
+        ips.append(visit.get("ip", "Unknown"))
+        paths.append(visit.get("path", "Unknown"))
+        tabs.append(visit.get("tab", "Unknown"))
+        days.append(ts[:10])  # ISO date prefix, same as parsing and taking .date()
+
         if visit.get("proxy") is True:
             vpn_count += 1
 
-        ts = visit.get("timestamp", "")
-        try:
-            dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-            by_day[dt.date().isoformat()] += 1
-        except Exception:
-            pass
+    by_country = Counter(countries)
+    by_path = Counter(paths)
+    by_tab = Counter(tabs)
 
-    most_visited_path = max(by_path.items(), key=lambda x: x[1])[0] if by_path else None
-    most_visited_tab = max(by_tab.items(), key=lambda x: x[1])[0] if by_tab else None
+    most_visited_path = by_path.most_common(1)[0][0] if by_path else None
+    most_visited_tab = by_tab.most_common(1)[0][0] if by_tab else None
 
     return {
-        "total_visits": len(visits),
+        "total_visits": len(countries),
         "by_country": dict(by_country),
-        "by_device": dict(by_device),
-        "by_ip": dict(by_ip),
-        "by_day": dict(by_day),
+        "by_device": dict(Counter(devices)),
+        "by_ip": dict(Counter(ips)),
+        "by_day": dict(Counter(days)),
         "by_path": dict(by_path),
         "by_tab": dict(by_tab),
         "most_visited_path": most_visited_path,
         "most_visited_tab": most_visited_tab,
-        "unknown_country_count": unknown_country_count,
+        "unknown_country_count": by_country["Unknown"],
         "vpn_count": vpn_count,
     }
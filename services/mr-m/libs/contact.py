@@ -1,33 +1,74 @@
 # libs/contact.py
 import os
 import time
-from collections import defaultdict, deque
+import asyncio
+from threading import Lock
+from queue import LifoQueue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 import smtplib
 
 # Optional: pull secrets from SSM if not in env
 try:
-    from libs.utils import getenv_or_ssm, first_nonempty_env
+    from libs.utils import getenv_or_ssm, first_nonempty_env, ssm_prefetch
 except Exception:
+    def ssm_prefetch(param_names, **_):
+        return None
+
     def getenv_or_ssm(env_name, ssm_path=None, **_):
         return os.getenv(env_name)
 
-# --- simple in-memory rate limit (per IP, rolling window) ---
+    def first_nonempty_env(*names):
+        for n in names:
+            v = os.getenv(n)
+            if v and v.strip():
+                return v.strip()
+        return None
+
+# --- simple in-memory rate limit (per IP, token bucket) ---
 _WINDOW_SECONDS = int(os.getenv("CONTACT_WINDOW_SECONDS", "3600"))  # 1 hour
 _MAX_PER_WINDOW = int(os.getenv("CONTACT_MAX_PER_WINDOW", "5"))
 
-_hits: defaultdict[str, deque] = defaultdict(deque)
+_CAPACITY = float(_MAX_PER_WINDOW)
+_REFILL = _MAX_PER_WINDOW / _WINDOW_SECONDS  # tokens per second
 
-def _too_many(ip: str) -> bool:
-    now = time.time()
+# ip -> (tokens, last_refill): two floats per IP, nothing to clean up per hit
+_buckets: dict[str, tuple[float, float]] = {}
+_buckets_lock = Lock()
+_SWEEP_EVERY = 1024
+_sweep_counter = 0
+
+def _refilled(ip: str, now: float) -> float:
+    tokens, last = _buckets.get(ip, (_CAPACITY, now))
+    return min(_CAPACITY, tokens + (now - last) * _REFILL)
+
+def _sweep(now: float) -> None:
+    """Drop buckets idle for a full window: they have refilled, so they equal a missing entry. Call under the lock."""
     cutoff = now - _WINDOW_SECONDS
-    q = _hits[ip]
-    while q and q[0] < cutoff:
-        q.popleft()
-    return len(q) >= _MAX_PER_WINDOW
+    for ip in [ip for ip, (_, last) in _buckets.items() if last < cutoff]:
+        del _buckets[ip]
+
+def _take_token(ip: str) -> bool:
+    """Spend one token if the IP has one. Check and spend share one critical section,
+    so concurrent submissions from an IP can't all pass before any is charged."""
+    global _sweep_counter
+    now = time.time()
+    with _buckets_lock:
+        _sweep_counter += 1
+        if _sweep_counter >= _SWEEP_EVERY:
+            _sweep_counter = 0
+            _sweep(now)
+        tokens = _refilled(ip, now)
+        if tokens < 1:
+            return False
+        _buckets[ip] = (tokens - 1, now)
+        return True
 
-def _record(ip: str) -> None:
-    _hits[ip].append(time.time())
+def _refund(ip: str) -> None:
+    # give the token back when the send fails, so server-side errors don't cost the sender
+    now = time.time()
+    with _buckets_lock:
+        _buckets[ip] = (min(_CAPACITY, _refilled(ip, now) + 1), now)
 
 def _human_delay_ok(submitted_at: str, min_ms: int = 1500) -> bool:
     """Reject forms submitted 'too fast' after page load (bots)."""
@@ -38,47 +79,25 @@ def _human_delay_ok(submitted_at: str, min_ms: int = 1500) -> bool:
         # If missing/invalid, don't block legit users
         return True
 
-def send_contact_email(
-    *,
-    name: str,
-    email: str,
-    message: str,
-    ip: str | None = None,
-    honeypot: str = "",
-    submitted_at: str = "",   # from hidden field, optional
-) -> dict:
-    """
-    Returns: {"ok": True} on success, otherwise {"ok": False, "error": "..."}.
-    """
+# --- SMTP config: resolved once, refreshed every few minutes (rotated secrets) ---
+_SMTP_CONFIG_TTL = int(os.getenv("SMTP_CONFIG_TTL_SECONDS", "600"))
+_smtp_config: dict | None = None
+_smtp_config_at = 0.0
 
-    # 🪤 Honeypot: if filled, pretend success (don’t tip off bots)
-    if honeypot and honeypot.strip():
-        print("[contact] honeypot triggered; skipping send")
-        return {"ok": True}
+_SMTP_SSM_PARAMS = [
+    "/majidkhoshrou/prod/SMTP_USER",
+    "/majidkhoshrou/prod/SMTP_PASSWORD",
+    "/majidkhoshrou/prod/CONTACT_RECIPIENT",
+]
 
-    # Optional: time trap (fast submissions look botty)
-    if not _human_delay_ok(submitted_at):
-        print("[contact] too-fast submission; skipping send")
-        return {"ok": True}
-
-    ip = ip or "unknown"
-
-    # throttle
-    if _too_many(ip):
-        return {"ok": False, "error": "Too many messages from this IP. Try again later."}
-
-    # validate inputs
-    name = (name or "").strip()
-    email = (email or "").strip()
-    message = (message or "").strip()
-    if not name or not email or not message:
-        return {"ok": False, "error": "Please fill in all required fields."}
-    if len(message) > 10_000:
-        return {"ok": False, "error": "Message is too long."}
+def _load_smtp_config() -> dict:
+    # one batched SSM round trip for everything below that isn't set in env
+    if not (first_nonempty_env("SMTP_USERNAME", "SMTP_USER")
+            and first_nonempty_env("SMTP_PASSWORD", "SMTP_PASS")
+            and first_nonempty_env("CONTACT_RECIPIENT")):
+        ssm_prefetch(_SMTP_SSM_PARAMS)
 
     # SMTP / Gmail config (env first, then SSM fallback)
-    from libs.utils import getenv_or_ssm, first_nonempty_env
-
     smtp_host = first_nonempty_env("SMTP_HOST", "SMTP_SERVER") or "smtp.gmail.com"
     smtp_port = int(first_nonempty_env("SMTP_PORT", "MAIL_PORT") or "587")
     use_tls   = (os.getenv("SMTP_USE_TLS", "true").lower() == "true")
@@ -100,21 +119,141 @@ def send_contact_email(
         or getenv_or_ssm("CONTACT_RECIPIENT", "/majidkhoshrou/prod/CONTACT_RECIPIENT")
     )
 
-    if not all([smtp_host, smtp_port, smtp_user, smtp_pass, recipient]):
-        return {"ok": False, "error": "Email service is not configured on the server."}
+    return {
+        "host": smtp_host,
+        "port": smtp_port,
+        "use_tls": use_tls,
+        "user": smtp_user,
+        "password": smtp_pass,
+        "recipient": recipient,
+    }
+
+def _get_smtp_config() -> dict | None:
+    """Cached SMTP config, or None if incomplete (incomplete results aren't cached, so SSM is retried)."""
+    global _smtp_config, _smtp_config_at
+    now = time.time()
+    if _smtp_config is not None and now - _smtp_config_at < _SMTP_CONFIG_TTL:
+        return _smtp_config
+    cfg = _load_smtp_config()
+    if not all(cfg[k] for k in ("host", "port", "user", "password", "recipient")):
+        return None
+    _smtp_config, _smtp_config_at = cfg, now
+    return cfg
+
+# --- SMTP connection pool: reuse TCP+TLS+AUTH across sends ---
+_SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "5"))
+_SMTP_MAX_SENDS_PER_CONN = 100
+_SMTP_TIMEOUT = 30
+# LIFO so the most recently used (least likely to have idled out) connection is reused first
+_smtp_pool: LifoQueue = LifoQueue(maxsize=_SMTP_POOL_SIZE)
+
+def _smtp_key(cfg: dict) -> tuple:
+    return (cfg["host"], cfg["port"], cfg["use_tls"], cfg["user"], cfg["password"])
+
+def _smtp_connect(cfg: dict) -> smtplib.SMTP:
+    if cfg["use_tls"]:
+        server = smtplib.SMTP(cfg["host"], cfg["port"], timeout=_SMTP_TIMEOUT)
+        server.starttls()
+    else:
+        server = smtplib.SMTP_SSL(cfg["host"], cfg["port"], timeout=_SMTP_TIMEOUT)
+    server.login(cfg["user"], cfg["password"])
+    return server
+
+def _smtp_close(server: smtplib.SMTP) -> None:
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+def _get_conn(cfg: dict) -> tuple[smtplib.SMTP, int]:
+    """Pooled (connection, sends_so_far) for this config; stale or mismatched ones are dropped."""
+    key = _smtp_key(cfg)
+    while True:
+        try:
+            server, sent, server_key = _smtp_pool.get_nowait()
+        except Empty:
+            return _smtp_connect(cfg), 0
+        if server_key == key:
+            try:
+                if server.noop()[0] == 250:
+                    return server, sent
+            except (smtplib.SMTPException, OSError):
+                pass
+        _smtp_close(server)
+
+def _return_conn(cfg: dict, server: smtplib.SMTP, sent: int) -> None:
+    if sent >= _SMTP_MAX_SENDS_PER_CONN:
+        _smtp_close(server)
+        return
+    try:
+        _smtp_pool.put_nowait((server, sent, _smtp_key(cfg)))
+    except Full:
+        _smtp_close(server)
+
+def _smtp_send(cfg: dict, msg: EmailMessage) -> None:
+    server, sent = _get_conn(cfg)
+    try:
+        try:
+            server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # dropped between NOOP and send: reconnect once
+            _smtp_close(server)
+            server, sent = _smtp_connect(cfg), 0
+            server.send_message(msg)
+    except Exception:
+        _smtp_close(server)
+        raise
+    _return_conn(cfg, server, sent + 1)
+
+# --- background sending: reply right after validation, deliver on a worker thread ---
+# off on Lambda, where threads are frozen as soon as the response is returned
+_on_lambda = os.getenv("AWS_EXECUTION_ENV", "").startswith("AWS_Lambda_")
+ASYNC_SEND = os.getenv("CONTACT_ASYNC_SEND", "0" if _on_lambda else "1") == "1"
+_smtp_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="smtp") if ASYNC_SEND else None
+
+def _send_in_background(cfg: dict, msg: EmailMessage) -> None:
+    try:
+        _smtp_send(cfg, msg)
+    except Exception as e:
+        print("❌ send_contact_email (background) error:", repr(e))
+
+_SEND_FAILED = {"ok": False, "error": "Failed to send your message. Please try again later."}
+
+def _check_submission(name, email, message, ip, honeypot, submitted_at):
+    """Shared bot/throttle/validation gate. Returns (response, None) to stop early, else (None, fields)."""
+    # 🪤 Honeypot: if filled, pretend success (don’t tip off bots)
+    if honeypot and honeypot.strip():
+        print("[contact] honeypot triggered; skipping send")
+        return {"ok": True}, None
 
-    # smtp_host = os.getenv("SMTP_HOST") or os.getenv("SMTP_SERVER") or "smtp.gmail.com"
-    # smtp_port = int(os.getenv("SMTP_PORT", os.getenv("MAIL_PORT", "587")))
-    # smtp_user = getenv_or_ssm("SMTP_USERNAME", "/majidkhoshrou/prod/SMTP_USER") or \
-                # getenv_or_ssm("SMTP_USER", "/majidkhoshrou/prod/SMTP_USER")
-    # smtp_pass = getenv_or_ssm("SMTP_PASSWORD", "/majidkhoshrou/prod/SMTP_PASSWORD") or \
-                # getenv_or_ssm("SMTP_PASS", "/majidkhoshrou/prod/SMTP_PASSWORD")
-    # use_tls   = (os.getenv("SMTP_USE_TLS", "true").lower() == "true")
-    # recipient = os.getenv("CONTACT_RECIPIENT") or smtp_user
+    # Optional: time trap (fast submissions look botty)
+    if not _human_delay_ok(submitted_at):
+        print("[contact] too-fast submission; skipping send")
+        return {"ok": True}, None
 
-    # if not all([smtp_host, smtp_port, smtp_user, smtp_pass, recipient]):
-    #     return {"ok": False, "error": "Email service is not configured on the server."}
+    ip = ip or "unknown"
 
+    # validate inputs first, so typos don't cost a token
+    name = (name or "").strip()
+    email = (email or "").strip()
+    message = (message or "").strip()
+    if not name or not email or not message:
+        return {"ok": False, "error": "Please fill in all required fields."}, None
+    if len(message) > 10_000:
+        return {"ok": False, "error": "Message is too long."}, None
+
+    # throttle: the token is spent here; callers refund it if the send fails
+    if not _take_token(ip):
+        return {"ok": False, "error": "Too many messages from this IP. Try again later."}, None
+
+    cfg = _get_smtp_config()
+    if cfg is None:
+        _refund(ip)
+        return {"ok": False, "error": "Email service is not configured on the server."}, None
+
+    return None, (cfg, name, email, message, ip)
+
+def _build_message(cfg: dict, name: str, email: str, message: str, ip: str) -> EmailMessage:
     subject = f"New message from {name} (Contact Form)"
     body = (
         f"Name: {name}\n"
@@ -123,26 +262,84 @@ def send_contact_email(
         f"Message:\n{message}\n"
     )
 
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = f"Contact Form <{cfg['user']}>"
+    msg["To"] = cfg["recipient"]
+    msg["Reply-To"] = email
+    msg.set_content(body)
+    return msg
+
+def send_contact_email(
+    *,
+    name: str,
+    email: str,
+    message: str,
+    ip: str | None = None,
+    honeypot: str = "",
+    submitted_at: str = "",   # from hidden field, optional
+) -> dict:
+    """
+    Returns: {"ok": True} on success, otherwise {"ok": False, "error": "..."}.
+    """
+    response, fields = _check_submission(name, email, message, ip, honeypot, submitted_at)
+    if response is not None:
+        return response
+    cfg, ip = fields[0], fields[4]
+
     try:
-        msg = EmailMessage()
-        msg["Subject"] = subject
-        msg["From"] = f"Contact Form <{smtp_user}>"
-        msg["To"] = recipient
-        msg["Reply-To"] = email
-        msg.set_content(body)
-
-        if use_tls:
-            with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.starttls()
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
+        msg = _build_message(*fields)
+
+        if _smtp_executor is not None:
+            # counted on enqueue; delivery errors are only logged
+            _smtp_executor.submit(_send_in_background, cfg, msg)
         else:
-            with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
+            _smtp_send(cfg, msg)
 
-        _record(ip)
         return {"ok": True}
     except Exception as e:
         print("❌ send_contact_email error:", repr(e))
-        return {"ok": False, "error": "Failed to send your message. Please try again later."}
+        _refund(ip)
+        return dict(_SEND_FAILED)
+
+async def send_contact_email_async(
+    *,
+    name: str,
+    email: str,
+    message: str,
+    ip: str | None = None,
+    honeypot: str = "",
+    submitted_at: str = "",
+) -> dict:
+    """
+    Same contract as send_contact_email, for asyncio servers: sends with aiosmtplib
+    so the event loop isn't blocked. Rate-limit state is shared with the sync path
+    (its lock is only held for a dict update, never across an await).
+    """
+    import aiosmtplib  # imported lazily so the sync app doesn't load it
+
+    # the gate may resolve SMTP config through boto3/SSM, which blocks: keep it off the loop
+    response, fields = await asyncio.to_thread(
+        _check_submission, name, email, message, ip, honeypot, submitted_at)
+    if response is not None:
+        return response
+    cfg, ip = fields[0], fields[4]
+
+    try:
+        msg = _build_message(*fields)
+        # connections are bound to their event loop, so no cross-request pool here
+        async with aiosmtplib.SMTP(
+            hostname=cfg["host"],
+            port=cfg["port"],
+            use_tls=not cfg["use_tls"],
+            start_tls=cfg["use_tls"],
+            timeout=_SMTP_TIMEOUT,
+        ) as server:
+            await server.login(cfg["user"], cfg["password"])
+            await server.send_message(msg)
+
+        return {"ok": True}
+    except Exception as e:
+        print("❌ send_contact_email_async error:", repr(e))
+        _refund(ip)
+        return dict(_SEND_FAILED)
@@ -1,18 +1,24 @@
 from pathlib import Path
-from PIL import Image, ImageOps
+from PIL import Image
 import cv2
 import numpy as np
 
 def extract_frames_from_video(video_path: Path, output_dir: Path, num_frames: int = 15):
     cap = cv2.VideoCapture(str(video_path))
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_indices = [int(i) for i in 
-                     list(np.linspace(0, total_frames - 1, num_frames))]
-    
+    wanted = set(np.linspace(0, total_frames - 1, num_frames, dtype=int).tolist())
+    last = max(wanted, default=-1)
+
+    # Walk the stream once instead of seeking per frame: every CAP_PROP_POS_FRAMES
+    # seek re-decodes from the previous keyframe. grab() skips the colour conversion
+    # for frames we don't keep.
     extracted_paths = []
-    for idx in frame_indices:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-        success, frame = cap.read()
+    for idx in range(last + 1):
+        if not cap.grab():
+            break
+        if idx not in wanted:
+            continue
+        success, frame = cap.retrieve()
         if not success:
             continue
         rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -24,7 +30,6 @@ def extract_frames_from_video(video_path: Path, output_dir: Path, num_frames: in
     return extracted_paths
 
 def make_gif_from_dir(path: Path, output_gif: str = "animated_output.gif", duration: int = 1000):
-    import numpy as np  # Needed for linspace in frame extraction
     path = Path(path)
     output_dir = path / "extracted_frames"
     output_dir.mkdir(exist_ok=True)
@@ -42,29 +47,53 @@ def make_gif_from_dir(path: Path, output_gif: str = "animated_output.gif", durat
     if not image_paths:
         raise FileNotFoundError("No MP4 or PNG files found in the specified directory.")
 
-    # Open and convert all images
-    images = [Image.open(p).convert("RGB") for p in image_paths]
-
-    # Determine max canvas size
-    max_width = max(img.width for img in images)
-    max_height = max(img.height for img in images)
+    # Canvas size from the headers only; frames are decoded one at a time below
+    sizes = []
+    for p in image_paths:
+        with Image.open(p) as im:
+            sizes.append(im.size)
+    max_width = max(w for w, _ in sizes)
+    max_height = max(h for _, h in sizes)
 
-    # Resize and pad
+    # Resize and pad (OpenCV's SIMD resize + border fill; same result as ImageOps.pad)
     def pad_image(img):
-        return ImageOps.pad(
-            img,
-            (max_width, max_height),
-            method=Image.Resampling.LANCZOS,  # or Image.ANTIALIAS for older PIL
-            color=(255, 255, 255),
-            centering=(0.5, 0.5)
-        )
+        w, h = img.size
+        scale = min(max_width / w, max_height / h)
+        new_w, new_h = max(1, round(w * scale)), max(1, round(h * scale))
+        frame = np.asarray(img)
+        if (new_w, new_h) != (w, h):
+            frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+        left = (max_width - new_w) // 2
+        top = (max_height - new_h) // 2
+        frame = cv2.copyMakeBorder(frame, top, max_height - new_h - top, left, max_width - new_w - left,
+                                   cv2.BORDER_CONSTANT, value=(255, 255, 255))
+        return Image.fromarray(frame)
 
-    padded_images = [pad_image(img) for img in images]
+    def load_padded(p):
+        with Image.open(p) as im:
+            return pad_image(im.convert("RGB"))
+
+    # One adaptive palette from the first frame, shared by all frames: no per-frame
+    # requantization (less colour flicker) and frames stream through the encoder
+    first = load_padded(image_paths[0]).quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+    rest = (
+        load_padded(p).quantize(palette=first, dither=Image.Dither.FLOYDSTEINBERG)
+        for p in image_paths[1:]
+    )
 
     # Save GIF
     gif_path = path / output_gif
-    padded_images[0].save(gif_path, save_all=True, append_images=padded_images[1:], duration=duration, loop=0)
+    first.save(gif_path, save_all=True, append_images=rest, duration=duration, loop=0,
+               optimize=True, disposal=2)
     print(f"GIF saved at: {gif_path}")
 
-# Usage example
-make_gif_from_dir(Path('/mnt/c/Users/al27278/OneDrive - Alliander NV/Output/create_gif/ask_mr_m'))
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build an animated GIF from the MP4s and PNGs in a directory.")
+    parser.add_argument("directory", type=Path, help="Directory with *.mp4 and/or *.png files")
+    parser.add_argument("--output", default="animated_output.gif", help="GIF file name (written into the directory)")
+    parser.add_argument("--duration", type=int, default=1000, help="Milliseconds per frame")
+    args = parser.parse_args()
+
+    make_gif_from_dir(args.directory, output_gif=args.output, duration=args.duration)
@@ -1,26 +1,47 @@
 # libs/ratelimiter.py
 import os
+import time
+import logging
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal
 
+logger = logging.getLogger(__name__)
+
 # --- Config ---
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", "6"))  # requests per day
 TABLE_NAME = os.getenv("RATE_TABLE_NAME")       # set by SAM in prod
 
 # --- Helpers ---
+# Both values only change once per second, so compute them at most once per
+# wall-clock second; each cache is a single tuple, swapped atomically.
+_today_cache = (-1, "")
+_ttl_cache = (-1, 0)
+
 def _today_str() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    global _today_cache
+    sec = int(time.time())
+    if _today_cache[0] != sec:
+        _today_cache = (sec, datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    return _today_cache[1]
 
 def _ttl_until_midnight_utc() -> int:
-    now = datetime.now(timezone.utc)
-    midnight = datetime.combine((now + timedelta(days=1)).date(), datetime.min.time(), tzinfo=timezone.utc)
-    # small buffer so DynamoDB TTL cleanup isn't time-critical
-    return max(60, int((midnight - now).total_seconds()) + 300)
+    global _ttl_cache
+    sec = int(time.time())
+    if _ttl_cache[0] != sec:
+        now = datetime.now(timezone.utc)
+        midnight = datetime.combine((now + timedelta(days=1)).date(), datetime.min.time(), tzinfo=timezone.utc)
+        # small buffer so DynamoDB TTL cleanup isn't time-critical
+        _ttl_cache = (sec, max(60, int((midnight - now).total_seconds()) + 300))
+    return _ttl_cache[1]
 
 def _get_ip_key(ip: str) -> str:
     # include date so caps reset daily regardless of TTL processing lag
     return f"ratelimit:v3:{_today_str()}:{ip}"
 
+def _get_day_key() -> str:
+    # Redis: one hash per day (field = IP) instead of one top-level key per IP
+    return f"ratelimit:v3:{_today_str()}"
+
 # --- Backend 1: DynamoDB (prod) ---
 _ddb_table = None
 def _get_ddb_table():
@@ -63,8 +84,28 @@ def _ddb_get_quota(ip: str) -> dict:
 
 # --- Backend 2: Redis (local optional) ---
 _r = None
+_incr_script = None
+
+# HINCRBY + (re)arm the day hash's expiry in one atomic round trip.
+# KEYS[2] is the per-IP string key used before the day hash: on an IP's first touch of
+# the day its count is carried over, so a deploy mid-day doesn't reset anyone's usage.
+_INCR_WITH_TTL_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    local legacy = redis.call('GET', KEYS[2])
+    if legacy then
+        redis.call('HSET', KEYS[1], ARGV[1], legacy)
+        redis.call('DEL', KEYS[2])
+    end
+end
+local v = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return v
+"""
+
 def _get_redis():
-    global _r
+    global _r, _incr_script
     if _r is not None:
         return _r
     host = os.getenv("REDIS_HOST")
@@ -79,26 +120,27 @@ def _get_redis():
         password=os.getenv("REDIS_PASSWORD"),
         decode_responses=True,
     )
+    _incr_script = _r.register_script(_INCR_WITH_TTL_LUA)
     return _r
 
 def _redis_check_and_increment(ip: str) -> bool:
     r = _get_redis()
     if not r:
         raise RuntimeError("Redis not configured")
-    key = _get_ip_key(ip)
-    new_value = r.incr(key)
-    ttl = r.ttl(key)
-    if new_value == 1 or ttl is None or ttl < 0:
-        r.expire(key, _ttl_until_midnight_utc())
+    new_value = int(_incr_script(keys=[_get_day_key(), _get_ip_key(ip)], args=[ip, _ttl_until_midnight_utc()]))
     return new_value <= RATE_LIMIT
 
 def _redis_get_quota(ip: str) -> dict:
     r = _get_redis()
     if not r:
         raise RuntimeError("Redis not configured")
-    key = _get_ip_key(ip)
-    used = int(r.get(key) or 0)
-    ttl = r.ttl(key)
+    key = _get_day_key()
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(key, ip)
+    pipe.ttl(key)
+    pipe.get(_get_ip_key(ip))  # pre-hash counter, until the IP's next increment migrates it
+    raw_used, ttl, legacy_used = pipe.execute()
+    used = int(raw_used or legacy_used or 0)
     if used > 0 and (ttl is None or ttl < 0):
         r.expire(key, _ttl_until_midnight_utc())
         ttl = r.ttl(key)
@@ -132,13 +174,13 @@ def check_and_increment_ip(ip: str) -> bool:
         if TABLE_NAME:
             return _ddb_check_and_increment(ip)
     except Exception as e:
-        print(f"[RateLimiter] DDB error for IP {ip}: {e}")
+        logger.warning("[RateLimiter] DDB error for IP %s: %s", ip, e)
     # Then Redis if configured
     try:
         if _get_redis():
             return _redis_check_and_increment(ip)
     except Exception as e:
-        print(f"[RateLimiter] Redis error for IP {ip}: {e}")
+        logger.warning("[RateLimiter] Redis error for IP %s: %s", ip, e)
     # Fallback to memory
     return _mem_check_and_increment(ip)
 
@@ -147,10 +189,10 @@ def get_ip_quota(ip: str) -> dict:
         if TABLE_NAME:
             return _ddb_get_quota(ip)
     except Exception as e:
-        print(f"[RateLimiter] DDB error for IP {ip}: {e}")
+        logger.warning("[RateLimiter] DDB error for IP %s: %s", ip, e)
     try:
         if _get_redis():
             return _redis_get_quota(ip)
     except Exception as e:
-        print(f"[RateLimiter] Redis error for IP {ip}: {e}")
+        logger.warning("[RateLimiter] Redis error for IP %s: %s", ip, e)
     return _mem_get_quota(ip)
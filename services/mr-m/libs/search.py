@@ -1,48 +1,313 @@
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Union
 import os
+import asyncio
+import re
+import sqlite3
+import time
+import hashlib
+from threading import Lock, Event
 import numpy as np
 import faiss
 import tiktoken
 from functools import lru_cache
 from libs.utils import get_openai_client  # reads OPENAI_API_KEY from env or SSM
 
+try:
+    import pyarrow as pa  # in requirements; guarded so a bare checkout still serves from the pickle
+except ImportError:
+    pa = None
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+
 @lru_cache(maxsize=1)
 def _client():
     return get_openai_client()
 
+# ------------------------------
+# Query embedding cache (in-process LRU + write-through sqlite)
+# ------------------------------
+_WS_RE = re.compile(r"\s+")
+_cache_lock = Lock()
+_cache_conn: Optional[sqlite3.Connection] = None
+
+def _default_cache_path() -> Path:
+    override = os.getenv("EMBED_CACHE_PATH")
+    if override:
+        return Path(override)
+    # Lambda: only /tmp is writable
+    if os.getenv("AWS_EXECUTION_ENV", "").startswith("AWS_Lambda_"):
+        return Path("/tmp/data/embed_cache.sqlite")
+    return Path(__file__).resolve().parent.parent / "data" / "embed_cache.sqlite"
+
+def _cache_db() -> Optional[sqlite3.Connection]:
+    global _cache_conn
+    if _cache_conn is None:
+        try:
+            path = _default_cache_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(path), check_same_thread=False)
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, vec BLOB)")
+            _cache_conn = conn
+        except Exception as e:
+            print(f"[search] embedding cache disabled: {e}")
+            return None
+    return _cache_conn
+
+def _cache_key(text: str, model: str) -> str:
+    # vectors from different models aren't comparable, so the model is part of the key
+    return hashlib.blake2b(f"{model}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+def _cache_get(text: str, model: str) -> Optional[bytes]:
+    conn = _cache_db()
+    if conn is None:
+        return None
+    try:
+        with _cache_lock:
+            row = conn.execute("SELECT vec FROM cache WHERE key = ?", (_cache_key(text, model),)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+def _cache_put(text: str, model: str, vec: bytes) -> None:
+    conn = _cache_db()
+    if conn is None:
+        return
+    try:
+        with _cache_lock, conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, vec) VALUES (?, ?)", (_cache_key(text, model), vec))
+    except sqlite3.Error:
+        pass
+
+class EmbedBatcher:
+    """Coalesce concurrent embedding requests into a single API call.
+
+    The first caller to arrive becomes the leader: it waits `window` seconds for
+    other threads to queue their texts, then embeds the whole batch in one
+    request and hands each caller its vector. No background thread is needed,
+    so this is safe on Lambda where the process is frozen between invocations.
+    """
+
+    def __init__(self, model: str = EMBED_MODEL, window: float = 0.01, max_batch: int = 32):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = Lock()
+        self._pending: List[Dict[str, Any]] = []
+
+    def embed(self, text: str) -> List[float]:
+        slot = {"text": text, "done": Event(), "vec": None, "err": None}
+        with self._lock:
+            self._pending.append(slot)
+            leader = len(self._pending) == 1
+
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            for start in range(0, len(batch), self.max_batch):
+                self._run(batch[start:start + self.max_batch])
+
+        slot["done"].wait()
+        if slot["err"] is not None:
+            raise slot["err"]
+        return slot["vec"]
+
+    def _run(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            response = _client().embeddings.create(input=[s["text"] for s in batch], model=self.model)
+            for s, item in zip(batch, sorted(response.data, key=lambda d: d.index)):
+                s["vec"] = item.embedding
+        except Exception as e:
+            for s in batch:
+                s["err"] = e
+        finally:
+            for s in batch:
+                s["done"].set()
+
+_batcher = EmbedBatcher(EMBED_MODEL, window=float(os.getenv("EMBED_BATCH_WINDOW_MS", "10")) / 1000)
+
+def normalize_query(text: str) -> str:
+    """Collapse whitespace so near-identical queries share a cache entry.
+
+    This is also the text that gets embedded, so it must not change meaning: case is
+    kept, since names and acronyms embed differently from their lowercase forms.
+    """
+    return _WS_RE.sub(" ", text).strip()
+
+@lru_cache(maxsize=2048)
+def _embed(text: str, model: str = EMBED_MODEL) -> bytes:
+    """Return the float32 embedding of an already-normalized query as raw bytes.
+
+    Keyed by (text, model); bytes rather than an array so cached values are immutable.
+    """
+    cached = _cache_get(text, model)
+    if cached is not None:
+        return cached
+    if model == _batcher.model:
+        embedding = _batcher.embed(text)
+    else:
+        embedding = _client().embeddings.create(input=[text], model=model).data[0].embedding
+    vec = np.asarray(embedding, dtype="float32").tobytes()
+    _cache_put(text, model, vec)
+    return vec
+
+def embed_query(text: str, model: str = EMBED_MODEL) -> np.ndarray:
+    """Embedding for `text` as a (1, d) float32 array, served from cache when possible."""
+    return np.frombuffer(_embed(normalize_query(text), model), dtype="float32").reshape(1, -1)
+
+def faiss_build_info() -> str:
+    """Compile options of the loaded FAISS library, e.g. "OPTIMIZE AVX512 ".
+
+    faiss-cpu wheels ship generic/avx2/avx512/avx512_spr builds and load the widest
+    one the CPU supports (FAISS_OPT_LEVEL forces a level), so this is the quickest
+    way to see which distance kernels a deployment is actually running.
+    """
+    try:
+        return faiss.get_compile_options().strip()
+    except AttributeError:  # very old builds
+        return "unknown"
+
 def get_faiss_index(index_path: Path) -> faiss.Index:
-    """Load a FAISS index from a given file path."""
-    return faiss.read_index(str(index_path))
+    """Load a FAISS index from a given file path.
+
+    Opened read-only with IO_FLAG_MMAP, which only maps what faiss supports
+    mapping (IVF inverted lists); HNSW graphs and flat/PQ codes are still read
+    into process memory. Falls back to a plain read if the flags are rejected.
+    """
+    try:
+        return faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except Exception as e:
+        print(f"[search] mmap load not supported ({e}); reading index into memory")
+        return faiss.read_index(str(index_path))
 
 def load_metadata_pickle(path: Path) -> List[Dict]:
     import pickle
     with open(path, "rb") as f:
         return pickle.load(f)
 
+def load_metadata(path: Path) -> List[Dict]:
+    """Load chunk metadata, picking the reader from the file suffix (.pkl or .json)."""
+    path = Path(path)
+    if path.suffix == ".json":
+        try:
+            import orjson
+            return orjson.loads(path.read_bytes())
+        except ImportError:
+            import json
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+    return load_metadata_pickle(path)
+
+def to_columns(metadata: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """Split list-of-dicts metadata into the columns the chat path reads (SoA layout).
+
+    Columns are object arrays so search hits can be gathered with one fancy index.
+    """
+    return {
+        "source_path": np.array([m.get("source_path") or "" for m in metadata], dtype=object),
+        "text": np.array([m.get("text") or "" for m in metadata], dtype=object),
+    }
+
+def load_columns(metadata_path: Path) -> Dict[str, Any]:
+    """Load the chat-path columns, preferring the Arrow file next to `metadata_path`.
+
+    The Arrow file is memory-mapped: columns are zero-copy views into the page cache,
+    shared between worker processes, and only the rows a search returns are ever turned
+    into Python strings. Falls back to to_columns over the pickled metadata.
+    """
+    arrow_path = Path(metadata_path).with_suffix(".arrow")
+    if pa is not None and arrow_path.exists():
+        table = pa.ipc.open_file(pa.memory_map(str(arrow_path), "r")).read_all()
+        return {"source_path": table.column("source_path"), "text": table.column("text")}
+    return to_columns(load_metadata(metadata_path))
+
+def _gather(column, ids: np.ndarray) -> list:
+    """Rows `ids` of a column as a list; columns are NumPy object arrays or Arrow arrays."""
+    picked = column.take(ids)
+    return picked.tolist() if isinstance(picked, np.ndarray) else picked.to_pylist()
+
 def query_index(
-    question: str,
+    question: Union[str, List[str]],
+    index: faiss.Index,
+    columns: Dict[str, Any],
+    top_k: int = 5,
+    nprobe: Optional[int] = None
+) -> List[Tuple[str, str]]:
+    """Return (source_path, text) pairs for the `top_k` chunks nearest to `question`.
+
+    `question` may also be a list of queries (e.g. recent user turns); they are
+    searched in a single batched FAISS call and the hits merged by score.
+    """
+    questions = [question] if isinstance(question, str) else list(question)
+    if not questions:
+        return []
+
+    # Build the query embeddings (cached; OpenAI client is created lazily on a miss)
+    query_vectors = np.vstack([embed_query(q) for q in questions])
+    return _search(query_vectors, index, columns, top_k, nprobe)
+
+async def aquery_index(
+    question: Union[str, List[str]],
     index: faiss.Index,
-    metadata: List[Dict[str, Any]],
-    top_k: int = 5
-) -> List[Dict[str, Any]]:
-    # Build the query embedding using a lazily created OpenAI client
-    response = _client().embeddings.create(
-        input=question,
-        model="text-embedding-3-small"
-    )
-    query_vector = np.asarray(response.data[0].embedding, dtype="float32").reshape(1, -1)
-
-    distances, indices = index.search(query_vector, top_k)
-
-    results = []
-    for i, idx in enumerate(indices[0]):
-        if idx < len(metadata):
-            results.append(metadata[idx])
-    return results
+    columns: Dict[str, Any],
+    top_k: int = 5,
+    nprobe: Optional[int] = None
+) -> List[Tuple[str, str]]:
+    """Same contract as query_index, for asyncio servers.
+
+    Queries are embedded concurrently, so a multi-turn lookup pays for the slowest
+    embedding rather than their sum; the blocking pieces (HTTP on a cache miss, the
+    FAISS search, which releases the GIL) run in worker threads.
+    """
+    questions = [question] if isinstance(question, str) else list(question)
+    if not questions:
+        return []
+
+    vectors = await asyncio.gather(*(asyncio.to_thread(embed_query, q) for q in questions))
+    return await asyncio.to_thread(_search, np.vstack(vectors), index, columns, top_k, nprobe)
+
+def _search(
+    query_vectors: np.ndarray,
+    index: faiss.Index,
+    columns: Dict[str, Any],
+    top_k: int,
+    nprobe: Optional[int]
+) -> List[Tuple[str, str]]:
+    """Search `index` with one row per query and map the merged hits to (source_path, text)."""
+    faiss.normalize_L2(query_vectors)
+
+    # IVF indexes: more probed lists = better recall, slower search
+    if nprobe is not None and hasattr(index, "nprobe"):
+        index.nprobe = nprobe
+
+    distances, indices = index.search(query_vectors, top_k)
+
+    if len(query_vectors) == 1:
+        ids = indices[0]
+    else:
+        # inner product: higher is closer; L2: lower is closer
+        scores = distances.ravel() if index.metric_type == faiss.METRIC_INNER_PRODUCT else -distances.ravel()
+        order = np.argsort(-scores, kind="stable")
+        ranked = indices.ravel()[order]
+        ranked = ranked[ranked >= 0]
+        # first occurrence of each id, in rank order
+        _, first = np.unique(ranked, return_index=True)
+        ids = ranked[np.sort(first)][:top_k]
+
+    sources, texts = columns["source_path"], columns["text"]
+    # FAISS pads missing neighbours with -1
+    ids = ids[(ids >= 0) & (ids < len(texts))]
+    return list(zip(_gather(sources, ids), _gather(texts, ids)))
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # building the BPE rank table is the expensive part; do it once per process, on first use
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
 
 def build_rag_query(history, current_message, max_tokens=2500):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    encoding = _encoding()
 
     current_tokens = encoding.encode(current_message)
     current_token_count = len(current_tokens)
@@ -56,15 +321,13 @@ def build_rag_query(history, current_message, max_tokens=2500):
         if msg.get("role") == "user"
     ]
 
-    total_tokens = 0
-    selected = []
-    for msg in user_messages:
-        msg_tokens = encoding.encode(msg)
-        token_count = len(msg_tokens)
-        if total_tokens + token_count > remaining_tokens:
-            break
-        selected.insert(0, msg)
-        total_tokens += token_count
+    # one call tokenizes every message on tiktoken's native thread pool
+    token_counts = np.fromiter((len(tokens) for tokens in encoding.encode_batch(user_messages)),
+                               dtype=np.int64, count=len(user_messages))
+
+    # keep the longest newest-first run that fits: the number of prefix sums within budget
+    cut = int(np.searchsorted(np.cumsum(token_counts), remaining_tokens, side="right"))
+    selected = user_messages[:cut][::-1]  # back to chronological order
 
     selected.append(current_message)
     return " ".join(selected).strip()
@@ -1,5 +1,6 @@
 # backend/libs/utils.py
 import os
+import time
 import secrets
 from functools import lru_cache
 
@@ -20,14 +21,46 @@ def _safe_default(name: str, default: str | None):
     return default
 
 
-@lru_cache(maxsize=None)
+# SSM values are cached in process memory with a TTL so rotated secrets are picked up;
+# failed reads are not cached, so the next call retries
+_SSM_TTL_SECONDS = int(os.getenv("SSM_CACHE_TTL_SECONDS", "600"))
+_ssm_cache: dict[tuple, tuple[str, float]] = {}
+
+
+def _ssm_cached(key: tuple) -> str | None:
+    hit = _ssm_cache.get(key)
+    if hit is not None and time.monotonic() - hit[1] < _SSM_TTL_SECONDS:
+        return hit[0]
+    return None
+
+
 def ssm_get(param_name: str, *, decrypt: bool = True, region: str | None = None) -> str | None:
+    key = (param_name, decrypt, region)
+    v = _ssm_cached(key)
+    if v is not None:
+        return v
     try:
         resp = _ssm_client(region).get_parameter(Name=param_name, WithDecryption=decrypt)
-        return resp["Parameter"]["Value"]
+        v = resp["Parameter"]["Value"]
     except (NoCredentialsError, BotoCoreError, ClientError) as e:
         print(f"[warn] SSM get_parameter failed for {param_name}: {e}")
         return None
+    _ssm_cache[key] = (v, time.monotonic())
+    return v
+
+
+def ssm_prefetch(param_names: list[str], *, decrypt: bool = True, region: str | None = None) -> None:
+    """Warm the cache for several parameters with batched get_parameters calls (10 names per call)."""
+    todo = [n for n in dict.fromkeys(param_names) if _ssm_cached((n, decrypt, region)) is None]
+    for i in range(0, len(todo), 10):
+        try:
+            resp = _ssm_client(region).get_parameters(Names=todo[i:i + 10], WithDecryption=decrypt)
+        except (NoCredentialsError, BotoCoreError, ClientError) as e:
+            print(f"[warn] SSM get_parameters failed: {e}")
+            return
+        now = time.monotonic()
+        for p in resp.get("Parameters", []):
+            _ssm_cache[(p["Name"], decrypt, region)] = (p["Value"], now)
 
 
 def getenv_or_ssm(
@@ -85,10 +118,7 @@ def get_openai_api_key() -> str:
         _get_openai_api_key_cached.cache_clear()
     except Exception:
         pass
-    try:
-        ssm_get.cache_clear()  # in case the first SSM read failed/transient
-    except Exception:
-        pass
+    _ssm_cache.clear()  # in case the first SSM read failed/transient
     return ""
 
 @lru_cache(maxsize=1)
@@ -107,9 +137,15 @@ def get_openai_client():
     """Create the OpenAI client lazily and cache it."""
     global _openai_client
     if _openai_client is None:
+        import httpx
         from openai import OpenAI  # import here to avoid import-time work
         api_key = get_openai_api_key()
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY is not set")
-        _openai_client = OpenAI(api_key=api_key)
+        # explicit pool: every gunicorn thread can hold a keep-alive connection
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+        _openai_client = OpenAI(api_key=api_key, http_client=http_client)
     return _openai_client
@@ -1,194 +1,293 @@
 import uuid
-import fitz  # PyMuPDF
-import spacy
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from pathlib import Path
-import datetime 
+import datetime
 from urllib.parse import urljoin, urlparse
 import os
 import re
-import tiktoken
 from tqdm import tqdm
 from io import BytesIO
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-# Initialize tokenizer and config
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+try:
+    import orjson  # optional: faster serialization of the chunk file
+except ImportError:
+    orjson = None
+
+try:
+    import lxml  # noqa: F401  # C parser for BeautifulSoup, several times faster than html.parser
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Tokenizer config
 MAX_TOKENS = 500
 OVERLAP_TOKENS = 50
+URL_FETCH_WORKERS = 16
 
-def count_tokens(text: str) -> int:
-    return len(encoding.encode(text))
+@lru_cache(maxsize=1)
+def get_encoding():
+    # created lazily so each worker process builds its own encoder on first use
+    import tiktoken
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
 
 def split_text_into_chunks(text: str, max_tokens: int = 500, overlap: int = 50):
+    """Yield overlapping token windows as (chunk_text, token_count) pairs, decoding one at a time."""
+    if not text:
+        return
+    encoding = get_encoding()
     tokens = encoding.encode(text)
-    chunks = []
+    if len(tokens) <= max_tokens:
+        # single window: the text is its own decode, skip the slice + decode round trip
+        yield text, len(tokens)
+        return
     start = 0
     while start < len(tokens):
         end = min(start + max_tokens, len(tokens))
-        chunk = encoding.decode(tokens[start:end])
-        chunks.append(chunk)
+        yield encoding.decode(tokens[start:end]), end - start
+        if end == len(tokens):
+            # the next window would only repeat this one's overlap tail
+            break
         start += max_tokens - overlap
-    return chunks
 
 def clean_text(text: str) -> str:
-    return re.sub(r'\s+', ' ', text).strip()
-
-# Setup
-nlp = spacy.load("en_core_web_sm")
-html_dir = Path("templates")
-pdf_dir = Path("static/pdfs")
-output_path = Path("data/knowledge_chunks.json")
-
-html_files = list(html_dir.glob("**/*.html"))
-pdf_files = list(pdf_dir.glob("**/*.pdf"))
-external_urls = []
-knowledge_chunks = []
-
-# === Process local HTML files ===
-for html_file in tqdm(html_files, desc="Processing HTMLs"):
-    base_dict = {
+    # same result as re.sub(r'\s+', ' ', text).strip() (both use str.isspace), but the
+    # whitespace scan runs in C with no regex engine
+    return ' '.join(text.split())
+
+_NONSPACE_RE = re.compile(r'\S+')
+
+def _has_min_words(text: str, n: int) -> bool:
+    """True if text has more than n words; stops scanning at word n+1 instead of splitting it all."""
+    for i, _ in enumerate(_NONSPACE_RE.finditer(text)):
+        if i >= n:
+            return True
+    return False
+
+def new_base_dict(source_type: str, source_path: str) -> dict:
+    return {
         'id': str(uuid.uuid4()),
         'created_at': datetime.datetime.now(datetime.UTC).isoformat(),
-        'source_type': 'local',
-        'source_path': str(html_file),
+        'source_type': source_type,
+        'source_path': source_path,
     }
 
-    html = html_file.read_text(encoding='utf-8')
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["header", "nav", "footer", "script", "style"]):
+def build_chunks(base_dict: dict, text: str) -> list:
+    chunks = split_text_into_chunks(text, max_tokens=MAX_TOKENS, overlap=OVERLAP_TOKENS)
+    return [
+        {
+            **base_dict,
+            'text': chunk,
+            'token_count': n_tokens,
+            'chunk_id': f"{base_dict['id']}_{idx}",
+        }
+        for idx, (chunk, n_tokens) in enumerate(chunks, start=1)
+    ]
+
+# === Local HTML files ===
+_BOILERPLATE_TAGS = ["header", "nav", "footer", "script", "style", "noscript"]
+
+def _strip_boilerplate(soup: BeautifulSoup) -> None:
+    # drop non-content subtrees up front so one get_text() over the document yields only visible text
+    for tag in soup(_BOILERPLATE_TAGS):
         tag.decompose()
 
+# links to assets we can't turn into text; PDFs are handled, so they're not listed
+_SKIP_EXT_RE = re.compile(
+    r'\.(?:jpe?g|png|gif|webp|svg|ico|css|js|zip|gz|tar|mp3|mp4|mov|webm|woff2?|ttf)(?:[?#]|$)', re.IGNORECASE)
+
+def is_fetchable(href: str) -> bool:
+    return _SKIP_EXT_RE.search(href) is None
+
+def process_html_file(html_file: Path):
+    """Returns (chunks, external_urls) for one local HTML file."""
+    base_dict = new_base_dict('local', str(html_file))
+
+    html = html_file.read_text(encoding='utf-8')
+    soup = BeautifulSoup(html, HTML_PARSER)
+    _strip_boilerplate(soup)
+
     title = soup.title.string.strip() if soup.title and soup.title.string else "Untitled"
     base_dict['title'] = title
 
     text = clean_text(soup.get_text(strip=False))
     external_links = {}
+    external_urls = {}  # dict as an ordered set: O(1) dedup, first-seen order
     for a in soup.find_all('a', href=True):
         href = a['href'].strip()
         if href.startswith(('http://', 'https://')):
             external_links[a.get_text(strip=True)] = href
-            if href not in external_urls:
-                external_urls.append(href)
+            if is_fetchable(href):
+                external_urls[href] = None
     base_dict['external_links'] = external_links
 
-    chunks = split_text_into_chunks(text, max_tokens=MAX_TOKENS, overlap=OVERLAP_TOKENS)
-    for idx, chunk in enumerate(chunks):
-        chunk_dict = base_dict.copy()
-        chunk_dict['text'] = chunk
-        chunk_dict['token_count'] = count_tokens(chunk)
-        chunk_dict['chunk_id'] = f"{chunk_dict['id']}_{idx+1}"
-        knowledge_chunks.append(chunk_dict)
-
-
-# === Process local PDF files ===
-for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-    base_dict = {
-        'id': str(uuid.uuid4()),
-        'created_at': datetime.datetime.now(datetime.UTC).isoformat(),
-        'source_type': 'local',
-        'source_path': str(pdf_file),
-    }
-
-    pdf_stream = BytesIO(pdf_file.read_bytes())
-    doc = fitz.open(stream=pdf_stream, filetype="pdf")
-
-    # --- Title extraction ---
-    meta = doc.metadata
-    title = meta.get("title")
-
-    if not title or title.lower().startswith("untitled") or len(title.strip()) < 5:
-        # Heuristic: pick the largest-font text from the first page
-        first_page = doc[0]
-        data = first_page.get_text("dict")
-        candidates = []
-
-        for block in data.get("blocks", []):
-            for line in block.get("lines", []):
-                for span in line.get("spans", []):
-                    text = span["text"].strip()
-                    if text and len(text.split()) > 3:  # crude filter
-                        candidates.append((span["size"], text))
-
-        if candidates:
-            candidates.sort(key=lambda x: -x[0])  # largest font size first
-            title = candidates[0][1]
-        else:
-            title = pdf_file.stem
-
-    base_dict['title'] = title
-
-    # --- Text extraction ---
-    text = ""
-    for page in doc:
-        text += page.get_text("text")  # plain text
-    doc.close()
-
-    text = clean_text(text)
-    chunks = split_text_into_chunks(text, max_tokens=MAX_TOKENS, overlap=OVERLAP_TOKENS)
-
-    for idx, chunk in enumerate(chunks):
-        chunk_dict = base_dict.copy()
-        chunk_dict['text'] = chunk
-        chunk_dict['token_count'] = count_tokens(chunk)
-        chunk_dict['chunk_id'] = f"{chunk_dict['id']}_{idx+1}"
-        knowledge_chunks.append(chunk_dict)
-
-
-# === Process external URLs ===
-for url in tqdm(external_urls, desc="Processing External URLs"):
-    base_dict = {
-        'id': str(uuid.uuid4()),
-        'created_at': datetime.datetime.now(datetime.UTC).isoformat(),
-        'source_type': 'external',
-        'source_path': url
-    }
-
+    return build_chunks(base_dict, text), list(external_urls)
+
+# === Local PDF files ===
+def _pdf_text(doc) -> str:
+    # clean page by page: only one raw page string is alive at a time, instead of
+    # the whole raw document plus its cleaned copy
+    return " ".join(filter(None, (clean_text(page.get_text("text")) for page in doc)))
+
+def process_pdf_file(pdf_file: Path) -> list:
+    import fitz  # PyMuPDF; only imported when there are PDFs to read
+
+    base_dict = new_base_dict('local', str(pdf_file))
+
+    # open by path: MuPDF reads the file itself, no Python-side copy of the bytes;
+    # closed deterministically when the block ends, even if title/text extraction raises
+    with fitz.open(pdf_file, filetype="pdf") as doc:
+        # --- Title extraction ---
+        meta = doc.metadata
+        title = meta.get("title")
+
+        if not title or title.lower().startswith("untitled") or len(title.strip()) < 5:
+            # Heuristic: pick the largest-font text from the first page
+            first_page = doc[0]
+            data = first_page.get_text("dict")
+            candidates = []
+
+            for block in data.get("blocks", []):
+                for line in block.get("lines", []):
+                    for span in line.get("spans", []):
+                        text = span["text"].strip()
+                        if _has_min_words(text, 3):  # crude filter
+                            candidates.append((span["size"], text))
+
+            if candidates:
+                candidates.sort(key=lambda x: -x[0])  # largest font size first
+                title = candidates[0][1]
+            else:
+                title = pdf_file.stem
+
+        base_dict['title'] = title
+
+        # --- Text extraction ---
+        text = _pdf_text(doc)
+
+    return build_chunks(base_dict, text)
+
+# === External URLs ===
+@lru_cache(maxsize=1)
+def get_session() -> requests.Session:
+    # keep-alive pool sized to the fetch pool, so same-host URLs reuse TLS connections
+    session = requests.Session()
+    session.headers["User-Agent"] = "mr-m-knowledge-extractor/1.0 (+https://majidkhoshrou.com)"
+    adapter = HTTPAdapter(pool_connections=URL_FETCH_WORKERS, pool_maxsize=URL_FETCH_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def fetch_url(url: str):
+    """Network half of URL processing; returns (url, response or exception)."""
     try:
-        response = requests.get(url)
+        response = get_session().get(url, timeout=15)
         response.raise_for_status()
-        content_type = response.headers.get("Content-Type", "").lower()
-
-        if "html" in content_type:
-            soup = BeautifulSoup(response.text, "html.parser")
-            for tag in soup(["header", "nav", "footer", "script", "style"]):
-                tag.decompose()
-
-            title = soup.title.string.strip() if soup.title and soup.title.string else "Untitled"
-            base_dict['title'] = title
-            text = clean_text(soup.get_text(strip=False))
-
-        elif "pdf" in content_type:
-            pdf_stream = BytesIO(response.content)
-            doc = fitz.open(stream=pdf_stream, filetype="pdf")
-
-            text = ""
-            for page in doc:
-                text += page.get_text('text')
-            doc.close()
-
-            base_dict['title'] = urlparse(url).path.split("/")[-1]
-            text = clean_text(text)
-
-        else:
-            print(f"Unsupported content type: {content_type} for URL: {url}")
-            continue
-
-        chunks = split_text_into_chunks(text, max_tokens=MAX_TOKENS, overlap=OVERLAP_TOKENS)
-        for idx, chunk in enumerate(chunks):
-            chunk_dict = base_dict.copy()
-            chunk_dict['text'] = chunk
-            chunk_dict['token_count'] = count_tokens(chunk)
-            chunk_dict['chunk_id'] = f"{chunk_dict['id']}_{idx+1}"
-            knowledge_chunks.append(chunk_dict)
-
+        return url, response
     except requests.RequestException as e:
-        print(f"Error fetching {url}: {e}")
-
-# === Save chunks to JSON ===
-output_path.parent.mkdir(parents=True, exist_ok=True)
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(knowledge_chunks, f, indent=2, ensure_ascii=False)
-
-print(f"\n✅ Done. Extracted and chunked {len(knowledge_chunks)} items.")
+        return url, e
+
+def fetch_and_extract(url: str):
+    """Fetch a URL and, unless it's a PDF, turn it into chunks on the calling thread.
+
+    Returns (url, chunks | exception | response); a response is only returned for
+    PDFs, which must be parsed on the main thread.
+    """
+    url, result = fetch_url(url)
+    if isinstance(result, Exception):
+        return url, result
+    if "pdf" in result.headers.get("Content-Type", "").lower():
+        return url, result
+    return url, process_external_url(url, result)
+
+def process_external_url(url: str, response: requests.Response) -> list:
+    base_dict = new_base_dict('external', url)
+    content_type = response.headers.get("Content-Type", "").lower()
+
+    if "html" in content_type:
+        soup = BeautifulSoup(response.text, HTML_PARSER)
+        _strip_boilerplate(soup)
+
+        title = soup.title.string.strip() if soup.title and soup.title.string else "Untitled"
+        base_dict['title'] = title
+        text = clean_text(soup.get_text(strip=False))
+
+    elif "pdf" in content_type:
+        import fitz  # PyMuPDF
+
+        pdf_stream = BytesIO(response.content)
+        with fitz.open(stream=pdf_stream, filetype="pdf") as doc:
+            text = _pdf_text(doc)
+
+        base_dict['title'] = urlparse(url).path.split("/")[-1]
+
+    else:
+        print(f"Unsupported content type: {content_type} for URL: {url}")
+        return []
+
+    return build_chunks(base_dict, text)
+
+
+def main():
+    # Setup
+    html_dir = Path("templates")
+    pdf_dir = Path("static/pdfs")
+    output_path = Path("data/knowledge_chunks.json")
+
+    html_files = list(html_dir.glob("**/*.html"))
+    pdf_files = list(pdf_dir.glob("**/*.pdf"))
+    external_urls = {}  # ordered set across all pages
+    knowledge_chunks = []
+
+    # HTML parsing and PDF text extraction are CPU-bound: fan files out over all cores.
+    # map() yields in input order, so the merged output (and external URL list) stays
+    # deterministic.
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        # map() submits eagerly, so PDFs are queued behind the HTML files right away;
+        # ~4 tasks per worker keeps IPC low while still balancing uneven files
+        html_results = ex.map(process_html_file, html_files,
+                              chunksize=max(1, len(html_files) // (workers * 4)))
+        pdf_results = ex.map(process_pdf_file, pdf_files)
+
+        for chunks, urls in tqdm(html_results, total=len(html_files), desc="Processing HTMLs"):
+            knowledge_chunks.extend(chunks)
+            external_urls.update(dict.fromkeys(urls))
+
+        for chunks in tqdm(pdf_results, total=len(pdf_files), desc="Processing PDFs"):
+            knowledge_chunks.extend(chunks)
+
+    # Fetching is network-bound: overlap the requests, and parse HTML in the same
+    # workers so parsing overlaps other fetches. PDFs come back to this thread
+    # (PyMuPDF documents must not be used from several threads); map() keeps URL order.
+    with ThreadPoolExecutor(max_workers=URL_FETCH_WORKERS) as ex:
+        external_urls = list(external_urls)
+        fetched = ex.map(fetch_and_extract, external_urls)
+        for url, result in tqdm(fetched, total=len(external_urls), desc="Processing External URLs"):
+            if isinstance(result, Exception):
+                print(f"Error fetching {url}: {result}")
+                continue
+            if isinstance(result, requests.Response):
+                result = process_external_url(url, result)
+            knowledge_chunks.extend(result)
+
+    # === Save chunks to JSON ===
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # compact: the file is machine-read by the embedding step, and indenting
+    # roughly doubles its size and the time to write and parse it
+    if orjson is not None:
+        output_path.write_bytes(orjson.dumps(knowledge_chunks, option=orjson.OPT_APPEND_NEWLINE))
+    else:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(knowledge_chunks, f, ensure_ascii=False, separators=(",", ":"))
+            f.write("\n")
+
+    print(f"\n✅ Done. Extracted and chunked {len(knowledge_chunks)} items.")
+
+
+if __name__ == "__main__":
+    main()
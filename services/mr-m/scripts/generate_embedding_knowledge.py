@@ -7,47 +7,129 @@ import argparse
 from pathlib import Path
 from typing import Callable, Any, Dict, List, Set
 
+import httpx
 import numpy as np
 import faiss
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, APIStatusError, RateLimitError
 from tqdm import tqdm
+import re
 import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson  # optional: much faster parsing of large chunk files
+except ImportError:
+    orjson = None
+
+try:
+    from datasketch import MinHash, MinHashLSH  # optional: near-duplicate suppression
+except ImportError:
+    MinHash = MinHashLSH = None
+
+try:
+    import pyarrow as pa  # in requirements; without it only metadata.pkl is written
+except ImportError:
+    pa = None
+
+
+RETRY_BASE_SECONDS = 1.0
+RETRY_CAP_SECONDS = 60.0
+
+
+def _retry_after(e: Exception) -> float:
+    """Seconds the server asked us to wait (Retry-After header), or 0."""
+    response = getattr(e, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _is_retryable(e: Exception) -> bool:
+    # 400/401/403/404/422 won't fix themselves: fail fast instead of burning the retries
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return True
 
 
 def retry_with_backoff(fn: Callable[[], Any], retries: int = 5) -> Any:
+    # decorrelated jitter keeps concurrent batches from retrying in lockstep
+    wait = RETRY_BASE_SECONDS
     for attempt in range(retries):
         try:
             return fn()
         except Exception as e:
-            wait = (2 ** attempt) + random.uniform(0, 1)
+            if not _is_retryable(e) or attempt == retries - 1:
+                raise
+            wait = min(RETRY_CAP_SECONDS, random.uniform(RETRY_BASE_SECONDS, wait * 3))
+            wait = max(wait, _retry_after(e))
             print(f"⏳ Retry {attempt + 1}/{retries} in {wait:.2f}s due to error: {e}")
             time.sleep(wait)
-    raise RuntimeError("Failed after multiple retries.")
+
+
+def get_text_digest(text: str) -> bytes:
+    # callers pass already-stripped text; a content key, not a security boundary
+    return hashlib.sha256(text.encode("utf-8"), usedforsecurity=False).digest()
 
 
 def get_text_hash(text: str) -> str:
-    return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+    """Hex form of get_text_digest, used wherever the hash is persisted (metadata, cache keys)."""
+    return get_text_digest(text).hex()
 
 
 def load_chunks(path: Path) -> List[Dict[str, Any]]:
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def load_existing_hashes(path: Path) -> Set[str]:
-    if not path.exists():
-        return set()
-    with path.open("rb") as f:
-        metadata = pickle.load(f)
-    return {get_text_hash(m["embedding_input"]) for m in metadata}
+def load_existing_hashes(metadata: List[Dict[str, Any]]) -> Set[bytes]:
+    # raw 32-byte digests: about half the memory of hex strings in a large set.
+    # Records written since text_hash was added skip the rehash entirely.
+    return {bytes.fromhex(m["text_hash"]) if m.get("text_hash") else get_text_digest(m["embedding_input"])
+            for m in metadata}
+
+
+EMBED_BATCH_SIZE = 256
+EMBED_CONCURRENCY = 4
+# the embeddings endpoint rejects requests over 300k tokens in total; stay well under it
+EMBED_BATCH_MAX_TOKENS = 250_000
+
+
+NEAR_DUP_THRESHOLD = 0.85
+NEAR_DUP_PERM = 64
+NEAR_DUP_SHINGLE = 5
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def text_minhash(text: str):
+    words = _WORD_RE.findall(text.lower())
+    mh = MinHash(num_perm=NEAR_DUP_PERM)
+    for i in range(max(1, len(words) - NEAR_DUP_SHINGLE + 1)):
+        mh.update(" ".join(words[i:i + NEAR_DUP_SHINGLE]).encode("utf-8"))
+    return mh
 
 
-def embed_chunks(client: OpenAI, model: str, chunks: List[Dict[str, Any]], seen_hashes: Set[str]) -> (List[List[float]], List[Dict[str, Any]]):
-    embeddings = []
-    metadata = []
+def collect_pending(chunks: List[Dict[str, Any]], seen_hashes: Set[bytes],
+                    near_dups: bool = True) -> List[Dict[str, Any]]:
+    """Drop empty/already-embedded chunks and build the metadata record for the rest.
 
-    for chunk in tqdm(chunks, desc="🔢 Embedding chunks"):
+    With datasketch installed, chunks whose text is a near-duplicate (5-gram
+    Jaccard >= 0.85) of one queued earlier in the same run are skipped too. Only
+    this run's chunks are compared: matching against already-embedded records
+    would drop a lightly edited chunk as a copy of its own stale version.
+    """
+    lsh = None
+    if near_dups and MinHashLSH is not None:
+        lsh = MinHashLSH(threshold=NEAR_DUP_THRESHOLD, num_perm=NEAR_DUP_PERM)
+    pending = []
+    for chunk in chunks:
         title = chunk.get("title", "Untitled")
         text = chunk.get("text", "").strip()
         source = chunk.get("source_path", "")
@@ -56,78 +138,506 @@ def embed_chunks(client: OpenAI, model: str, chunks: List[Dict[str, Any]], seen_
             continue
 
         embedding_input = f"Source: {source}\nTitle: {title}\nText: {text}"
-        text_hash = get_text_hash(embedding_input)
+        digest = get_text_digest(embedding_input)
 
-        if text_hash in seen_hashes:
+        if digest in seen_hashes:
+            continue
+        seen_hashes.add(digest)
+
+        record = {
+            "id": chunk["id"],
+            "chunk_id": chunk.get("chunk_id"),
+            "title": title,
+            "source_path": chunk.get("source_path"),
+            "token_count": chunk.get("token_count"),
+            "text": text,
+            "embedding_input": embedding_input,  # 👈 add this
+            "text_hash": digest.hex(),
+        }
+
+        if lsh is not None:
+            mh = text_minhash(text)
+            if lsh.query(mh):
+                continue
+            lsh.insert(record["text_hash"], mh)  # unique here: exact repeats were skipped above
+
+        pending.append(record)
+    return pending
+
+
+class EmbeddingCache:
+    """Persistent sqlite store of (model, sha256(text)) -> float32 vector, shared across runs."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, vec BLOB)")
+
+    @staticmethod
+    def key(model: str, text_hash: str) -> str:
+        return f"{model}:{text_hash}"
+
+    def get(self, model: str, text_hash: str):
+        row = self.conn.execute("SELECT vec FROM cache WHERE key = ?", (self.key(model, text_hash),)).fetchone()
+        return np.frombuffer(row[0], dtype="float32") if row else None
+
+    def put_many(self, model: str, items) -> None:
+        # one transaction per batch
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, vec) VALUES (?, ?)",
+                [(self.key(model, text_hash), np.asarray(vec, dtype="float32").tobytes()) for text_hash, vec in items],
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class _Rows:
+    """Preallocated (N, d) embedding matrix plus a mask of the rows filled so far."""
+
+    def __init__(self, n: int):
+        self.data = None
+        self.ok = np.zeros(n, dtype=bool)
+
+    def set(self, row: int, vector) -> None:
+        if self.data is None:
+            self.data = np.empty((len(self.ok), len(vector)), dtype="float32")
+        self.data[row] = vector
+        self.ok[row] = True
+
+    def result(self, pending: List[Dict[str, Any]]) -> (np.ndarray, List[Dict[str, Any]]):
+        if self.data is None:
+            return np.empty((0, 0), dtype="float32"), []
+        if self.ok.all():
+            return self.data, pending
+        keep = np.flatnonzero(self.ok)
+        return self.data[keep], [pending[i] for i in keep]
+
+
+def _fill_from_cache(cache: EmbeddingCache, model: str, pending: List[Dict[str, Any]], rows: _Rows) -> List[int]:
+    """Fill cached rows; return the row ids that still need the API."""
+    if cache is None:
+        return list(range(len(pending)))
+    todo = []
+    for i, m in enumerate(pending):
+        vec = cache.get(model, m["text_hash"])
+        if vec is None:
+            todo.append(i)
+        else:
+            rows.set(i, vec)
+    if len(todo) < len(pending):
+        print(f"💾 {len(pending) - len(todo)} embeddings served from cache")
+    return todo
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 chars/token for English; /3 overestimates so a batch never crosses the limit
+    return len(text) // 3 + 1
+
+
+def make_batches(todo: List[int], pending: List[Dict[str, Any]], batch_size: int,
+                 max_tokens: int = EMBED_BATCH_MAX_TOKENS) -> List[List[int]]:
+    """Group row ids into requests capped at batch_size inputs and max_tokens estimated tokens.
+
+    Rows are packed shortest first, so batches fill evenly instead of a few long
+    chunks cutting one short; results are written back by row id, so order is free.
+    """
+    sizes = {i: _estimate_tokens(pending[i]["embedding_input"]) for i in todo}
+    batches, batch, tokens = [], [], 0
+    for i in sorted(todo, key=sizes.__getitem__):
+        n = sizes[i]
+        if batch and (len(batch) >= batch_size or tokens + n > max_tokens):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(i)
+        tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class AdaptiveLimit:
+    """Concurrency gate that halves on 429 and creeps back up by one per success (AIMD)."""
+
+    def __init__(self, maximum: int):
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self.in_flight -= 1
+            if exc_type is None:
+                self.limit = min(self.maximum, self.limit + 1)
+            elif issubclass(exc_type, RateLimitError):
+                self.limit = max(1, self.limit // 2)
+                print(f"🐢 Rate limited; concurrency -> {self.limit}")
+            self._cond.notify_all()
+        return False
+
+
+def embed_chunks(client: OpenAI, model: str, pending: List[Dict[str, Any]],
+                 batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY,
+                 cache: EmbeddingCache = None) -> (np.ndarray, List[Dict[str, Any]]):
+    rows = _Rows(len(pending))
+    todo = _fill_from_cache(cache, model, pending, rows)
+
+    # One API call per batch, several batches in flight at once (fewer after a 429).
+    # Rows are written straight into the preallocated matrix at their position.
+    gate = AdaptiveLimit(concurrency)
+
+    def embed_batch(batch):
+        inputs = [pending[i]["embedding_input"] for i in batch]
+
+        def call():
+            with gate:  # the backoff sleep happens outside the gate
+                return client.embeddings.create(model=model, input=inputs)
+
+        return retry_with_backoff(call)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        futs = {ex.submit(embed_batch, batch): batch for batch in make_batches(todo, pending, batch_size)}
+        for fut in tqdm(as_completed(futs), total=len(futs), desc="🔢 Embedding batches"):
+            batch = futs[fut]
+            try:
+                response = fut.result()
+            except Exception as e:
+                print(f"❌ Failed to embed batch starting at chunk {pending[batch[0]]['id']}: {e}")
+                continue
+            for item in response.data:
+                rows.set(batch[item.index], item.embedding)
+            if cache is not None:
+                cache.put_many(model, [(pending[i]["text_hash"], rows.data[i]) for i in batch if rows.ok[i]])
+
+    return rows.result(pending)
+
+
+BATCH_API_POLL_SECONDS = 30
+BATCH_API_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+# per input file; larger uploads are rejected, so big runs are split over several batches
+BATCH_API_MAX_REQUESTS = 50_000
+BATCH_API_MAX_BYTES = 200 * 1024 * 1024
+
+
+def split_batch_files(lines: List[bytes], max_requests: int = BATCH_API_MAX_REQUESTS,
+                      max_bytes: int = BATCH_API_MAX_BYTES) -> List[List[bytes]]:
+    """Group JSONL request lines into files within the Batch API's request and size limits."""
+    files, current, size = [], [], 0
+    for line in lines:
+        n = len(line) + 1  # trailing newline
+        if current and (len(current) >= max_requests or size + n > max_bytes):
+            files.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += n
+    if current:
+        files.append(current)
+    return files
+
+
+def embed_chunks_batch_api(client: OpenAI, model: str, pending: List[Dict[str, Any]],
+                           poll_seconds: int = BATCH_API_POLL_SECONDS,
+                           cache: EmbeddingCache = None) -> (np.ndarray, List[Dict[str, Any]]):
+    """Embed through the OpenAI Batch API: half the price, no rate-limit pressure, up to 24h latency."""
+    rows = _Rows(len(pending))
+    todo = _fill_from_cache(cache, model, pending, rows)
+    if not todo:
+        return rows.result(pending)
+
+    # custom_id is the row position, so results can be placed without a lookup
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": model, "input": pending[i]["embedding_input"]},
+        }).encode("utf-8")
+        for i in todo
+    ]
+    # submit every part before waiting on any, so the batches run side by side
+    batches = []
+    for part, file_lines in enumerate(split_batch_files(lines), start=1):
+        batch_file = client.files.create(
+            file=(f"embeddings_batch_{part}.jsonl", b"\n".join(file_lines) + b"\n"),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h",
+        )
+        print(f"📤 Submitted batch {batch.id} with {len(file_lines)} inputs")
+        batches.append(batch)
+
+    embedded = []
+    for batch in batches:
+        while batch.status not in BATCH_API_TERMINAL:
+            time.sleep(poll_seconds)
+            batch = client.batches.retrieve(batch.id)
+            print(f"⏳ Batch {batch.id}: {batch.status}")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            # rows of this part stay missing and are retried on the next run
+            print(f"❌ Batch {batch.id} ended with status {batch.status}")
             continue
-        seen_hashes.add(text_hash)
 
-        def call_api():
-            return client.embeddings.create(model=model, input=embedding_input)
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            row = int(result["custom_id"])
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                print(f"❌ Failed to embed chunk {pending[row]['id']}: {result.get('error')}")
+                continue
+            rows.set(row, response["body"]["data"][0]["embedding"])
+            embedded.append(row)
+
+    if cache is not None and embedded:
+        cache.put_many(model, [(pending[i]["text_hash"], rows.data[i]) for i in embedded])
+    return rows.result(pending)
+
+
+INDEX_TYPES = ("hnsw", "hnsw-sq8", "ivfpq", "ivfpq-fs", "ivf-sq8", "ivf-fp16", "flat")
+
+# IVF lists holding scalar-quantized vectors: 2x (fp16) or 4x (int8) fewer bytes
+# scanned per vector than fp32, with recall close to exact search
+_IVF_SQ_CODES = {"ivf-sq8": "SQ8", "ivf-fp16": "SQfp16"}
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    # number of PQ sub-vectors must divide the dimension
+    for m in (48, 96, 64, 32, 16, 8):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(dimension: int, index_type: str = "hnsw", train_vectors: np.ndarray = None) -> faiss.Index:
+    if index_type == "flat":
+        # exact cosine search; fine for small corpora
+        return faiss.IndexFlatIP(dimension)
+    if index_type in ("ivfpq", "ivfpq-fs") or index_type in _IVF_SQ_CODES:
+        n = 0 if train_vectors is None else len(train_vectors)
+        nlist = max(16, int(np.sqrt(n)))
+        # k-means wants ~39 training points per centroid: nlist centroids for the IVF lists,
+        # and 2**bits per PQ sub-quantizer (256 for 8-bit codes, 16 for 4-bit FastScan).
+        # Scalar quantizers only learn per-dimension ranges, so they need just the IVF part.
+        pq_bits = {"ivfpq": 8, "ivfpq-fs": 4}.get(index_type)
+        min_train = 39 * max(nlist, 2 ** pq_bits if pq_bits else 0)
+        if n >= min_train:
+            m = _pq_subquantizers(dimension)
+            if index_type in _IVF_SQ_CODES:
+                index = faiss.index_factory(dimension, f"IVF{nlist},{_IVF_SQ_CODES[index_type]}",
+                                            faiss.METRIC_INNER_PRODUCT)
+            elif index_type == "ivfpq-fs":
+                # 4-bit codes in FastScan's interleaved layout: the distance lookup tables fit
+                # in SIMD registers, so lists are scanned with shuffles instead of gathers
+                index = faiss.index_factory(dimension, f"IVF{nlist},PQ{m}x4fs", faiss.METRIC_INNER_PRODUCT)
+            else:
+                quantizer = faiss.IndexFlatIP(dimension)
+                index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+            index.train(train_vectors)
+            index.nprobe = 8
+            return index
+        print(f"⚠️ Only {n} vectors (need {min_train}); too few to train {index_type}, falling back to HNSW")
+
+    if index_type == "hnsw-sq8" and train_vectors is not None and len(train_vectors):
+        # same graph, but vectors stored as int8 codes (4x less RAM/bandwidth than fp32);
+        # training only learns per-dimension ranges, so any corpus size works
+        index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        index.train(train_vectors)
+        index.hnsw.efConstruction = 40
+        index.hnsw.efSearch = 16
+        return index
+
+    # HNSW graph over inner product: sublinear search, no training step.
+    # OpenAI embeddings are unit length, so IP on normalized vectors == cosine.
+    index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 40
+    index.hnsw.efSearch = 16
+    return index
+
+
+def append_vectors(vectors_path: Path, new_vectors: np.ndarray, expected_existing: int) -> None:
+    """Keep a raw (N, d) float16 copy of every embedding next to the index.
+
+    The index can then be rebuilt (e.g. with another --index-type) straight from
+    disk via --reindex, without calling the API again. float16 halves the file
+    and is effectively lossless for ranking; rows are cast back to float32 on load.
+    """
+    existing = None
+    if expected_existing and vectors_path.exists():
+        existing = np.load(vectors_path, mmap_mode="r")
+        if existing.shape[0] != expected_existing:
+            print(f"⚠️ {vectors_path} has {existing.shape[0]} rows but metadata has {expected_existing}; not updating it")
+            return
+    elif expected_existing:
+        # index predates the vector file; a partial file would misalign rows
+        return
 
-        try:
-            response = retry_with_backoff(call_api)
-            embedding = response.data[0].embedding
-
-            embeddings.append(embedding)
-            metadata.append({
-                "id": chunk["id"],
-                "chunk_id": chunk.get("chunk_id"),
-                "title": title,
-                "source_path": chunk.get("source_path"),
-                "token_count": chunk.get("token_count"),
-                "text": text,
-                "embedding_input": embedding_input  # 👈 add this
-            })
+    # write through a memmap: old rows are streamed across and new rows land in place,
+    # so neither the full matrix nor a concatenated copy is ever held in RAM
+    n_old = 0 if existing is None else existing.shape[0]
+    tmp_path = vectors_path.with_name(vectors_path.stem + ".tmp.npy")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype="float16",
+                                    shape=(n_old + new_vectors.shape[0], new_vectors.shape[1]))
+    if existing is not None:
+        out[:n_old] = existing
+    out[n_old:] = new_vectors
+    out.flush()
+    del out, existing  # release both mmaps before replacing the file
+    os.replace(tmp_path, vectors_path)
+
+
+def reindex(index_path: Path, metadata_path: Path, vectors_path: Path, index_type: str = "hnsw"):
+    """Rebuild the FAISS index from the stored vectors, without any API calls."""
+    vectors = np.load(vectors_path, mmap_mode="r")
+    with metadata_path.open("rb") as f:
+        metadata = pickle.load(f)
+    if vectors.shape[0] != len(metadata):
+        raise RuntimeError(f"{vectors_path} has {vectors.shape[0]} rows but metadata has {len(metadata)}")
 
-        except Exception as e:
-            print(f"❌ Failed to embed chunk {chunk.get('id')}: {e}")
+    vectors_np = np.array(vectors, dtype="float32")  # fp16 on disk -> writable fp32 copy for normalize_L2
+    faiss.normalize_L2(vectors_np)
+    index = create_index(vectors_np.shape[1], index_type, vectors_np)
+    index.add(vectors_np)
+    _replace_atomically(index_path, lambda p: faiss.write_index(index, str(p)))
+    print(f"📦 Rebuilt {index_type} index with {index.ntotal} vectors from {vectors_path}")
 
-    return embeddings, metadata
 
+def _replace_atomically(path: Path, write: Callable[[Path], None]) -> None:
+    """Write to a sibling temp file, then swap it in, so a crash never leaves a truncated file."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
 
-def save_faiss_index(index_path: Path, index, metadata_path: Path, metadata: List[Dict[str, Any]]):
-    faiss.write_index(index, str(index_path))
-    with metadata_path.open("wb") as f:
-        pickle.dump(metadata, f)
 
+def _pickle_to(obj) -> Callable[[Path], None]:
+    def write(path: Path) -> None:
+        with path.open("wb") as f:
+            pickle.dump(obj, f, protocol=5)
+    return write
+
+
+def _arrow_columns_to(metadata: List[Dict[str, Any]]) -> Callable[[Path], None]:
+    # only the columns the chat path reads; the app memory-maps this instead of unpickling
+    table = pa.table({
+        "source_path": [m.get("source_path") or "" for m in metadata],
+        "text": [m.get("text") or "" for m in metadata],
+    })
+
+    def write(path: Path) -> None:
+        with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return write
 
-def generate_embeddings(model: str, input_path: Path, index_path: Path, metadata_path: Path, force: bool = False):
+
+def check_index_matches(index, metadata: List[Dict[str, Any]], index_path: Path, metadata_path: Path) -> None:
+    """Refuse to build on an index whose rows no longer line up with the metadata.
+
+    Index and metadata are replaced one after the other, so a crash in between leaves
+    them from different runs; appending to such a pair would shift every later row.
+    """
+    if index.ntotal != len(metadata):
+        raise RuntimeError(
+            f"{index_path} has {index.ntotal} vectors but {metadata_path} has {len(metadata)} rows. "
+            "Rebuild the index with --reindex (if the vectors file still matches the metadata) "
+            "or from scratch with --rebuild."
+        )
+
+
+def save_faiss_index(index_path: Path, index, metadata_path: Path, metadata: List[Dict[str, Any]]):
+    _replace_atomically(index_path, lambda p: faiss.write_index(index, str(p)))
+    _replace_atomically(metadata_path, _pickle_to(metadata))
+    arrow_path = metadata_path.with_suffix(".arrow")
+    if pa is not None:
+        _replace_atomically(arrow_path, _arrow_columns_to(metadata))
+    elif arrow_path.exists():
+        # the app prefers the arrow file; a stale one would no longer line up with the index
+        arrow_path.unlink()
+        print(f"⚠️ pyarrow not installed; removed stale {arrow_path}")
+
+
+def generate_embeddings(model: str, input_path: Path, index_path: Path, metadata_path: Path, force: bool = False,
+                        index_type: str = "hnsw", batch_size: int = EMBED_BATCH_SIZE,
+                        concurrency: int = EMBED_CONCURRENCY, use_batch_api: bool = False,
+                        vectors_path: Path = None, cache_path: Path = None):
     load_dotenv()
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # size the keep-alive pool to the batch concurrency so parallel batches never wait on PoolTimeout
+    client = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_connections=max(16, concurrency * 2),
+                                max_keepalive_connections=max(8, concurrency)),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        ),
+    )
 
     chunks = load_chunks(input_path)
     print(f"📘 Loaded {len(chunks)} chunks")
 
     existing_hashes = set()
     existing_metadata = []
-    existing_index = None
+    incremental = not force and metadata_path.exists() and index_path.exists()
 
-    if not force and metadata_path.exists() and index_path.exists():
-        existing_hashes = load_existing_hashes(metadata_path)
+    if incremental:
         with metadata_path.open("rb") as f:
             existing_metadata = pickle.load(f)
-        existing_index = faiss.read_index(str(index_path))
+        # checked before any embedding work, so a mismatched pair costs no API calls
+        index = faiss.read_index(str(index_path))
+        check_index_matches(index, existing_metadata, index_path, metadata_path)
+        existing_hashes = load_existing_hashes(existing_metadata)
         print(f"🔁 Loaded {len(existing_metadata)} existing embeddings")
     else:
         print("⚠️ Starting fresh (no existing index or metadata found)")
 
-    new_embeddings, new_metadata = embed_chunks(client, model, chunks, existing_hashes)
+    pending = collect_pending(chunks, existing_hashes)
+
+    cache = EmbeddingCache(cache_path) if cache_path else None
+    try:
+        if use_batch_api:
+            new_embeddings_np, new_metadata = embed_chunks_batch_api(client, model, pending, cache=cache)
+        else:
+            new_embeddings_np, new_metadata = embed_chunks(client, model, pending, batch_size,
+                                                           concurrency, cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
-    if not new_embeddings:
+    if not new_metadata:
         print("⚠️ No new embeddings generated.")
         return
 
-    new_embeddings_np = np.array(new_embeddings).astype("float32")
+    existing_count = len(existing_metadata)
+    raw_embeddings = new_embeddings_np.copy() if vectors_path is not None else None
+    faiss.normalize_L2(new_embeddings_np)
 
-    if existing_index is None:
-        index = faiss.IndexFlatL2(len(new_embeddings_np[0]))
-    else:
-        index = existing_index
+    # New builds only create the index once there is something to add; incremental
+    # runs append the new rows to the index loaded (and checked) above.
+    if not incremental:
+        index = create_index(new_embeddings_np.shape[1], index_type, new_embeddings_np)
     index.add(new_embeddings_np)
 
-    total_metadata = existing_metadata + new_metadata
-    save_faiss_index(index_path, index, metadata_path, total_metadata)
+    # embedding_input is only needed while embedding; text_hash stands in for it from here on,
+    # so the stored metadata (which the app loads at startup) doesn't carry every text twice
+    for m in new_metadata:
+        m.pop("embedding_input", None)
+    existing_metadata.extend(new_metadata)
+    save_faiss_index(index_path, index, metadata_path, existing_metadata)
+    # sidecar last: if we die before this, append_vectors sees the row mismatch
+    # on the next run and leaves it alone rather than misaligning rows
+    if raw_embeddings is not None:
+        append_vectors(vectors_path, raw_embeddings, existing_count)
 
     print(f"\n✅ Saved {len(new_metadata)} new embeddings")
     print(f"📦 Total index size: {index.ntotal} vectors")
@@ -140,12 +650,37 @@ if __name__ == "__main__":
     parser.add_argument("--input", default="data/knowledge_chunks.json", help="Input JSON file")
     parser.add_argument("--index", default="data/faiss.index", help="Output FAISS index file")
     parser.add_argument("--metadata", default="data/metadata.pkl", help="Output metadata file")
+    parser.add_argument("--vectors", default="data/embeddings.npy", help="Raw float16 embeddings (N, d)")
+    parser.add_argument("--cache", default="data/embeddings_cache.sqlite",
+                        help="Persistent embedding cache keyed by model + text hash ('' to disable)")
+    parser.add_argument("--reindex", action="store_true",
+                        help="Rebuild the index from --vectors and --metadata without embedding anything")
+    parser.add_argument("--index-type", default="hnsw", choices=INDEX_TYPES,
+                        help="FAISS index for new builds (hnsw-sq8 stores int8 codes; ivf-sq8/ivf-fp16 are IVF over "
+                             "int8/fp16 codes; ivfpq compresses further for large corpora; ivfpq-fs "
+                             "uses 4-bit FastScan codes for faster scans)")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE,
+                        help="Inputs per embeddings request (API max 2048)")
+    parser.add_argument("--concurrency", type=int, default=EMBED_CONCURRENCY,
+                        help="Embedding requests in flight at once")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="Use the OpenAI Batch API (50%% cheaper, completes within 24h)")
     args = parser.parse_args()
 
+    if args.reindex:
+        reindex(Path(args.index), Path(args.metadata), Path(args.vectors), args.index_type)
+        raise SystemExit(0)
+
     generate_embeddings(
         model=args.model,
         input_path=Path(args.input),
         index_path=Path(args.index),
         metadata_path=Path(args.metadata),
-        force=args.rebuild
+        force=args.rebuild,
+        index_type=args.index_type,
+        batch_size=max(1, min(args.batch_size, 2048)),
+        concurrency=args.concurrency,
+        use_batch_api=args.batch_api,
+        vectors_path=Path(args.vectors),
+        cache_path=Path(args.cache) if args.cache else None,
     )
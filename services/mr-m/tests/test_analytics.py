@@ -0,0 +1,186 @@
+import json
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from queue import Queue
+from unittest.mock import MagicMock, patch
+
+from libs import analytics
+
+
+def visit(ts: datetime, **fields):
+    entry = {
+        "ip": "10.0.0.1",
+        "country": "Netherlands",
+        "device": "Desktop",
+        "user_agent": "",
+        "timestamp": ts.isoformat(),
+        "proxy": False,
+        "latitude": None,
+        "longitude": None,
+        "path": "/",
+        "tab": "Home",
+    }
+    entry.update(fields)
+    return entry
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.log_dir = Path(tmp.name)
+        self.log_file = self.log_dir / analytics.LOG_FILE_NAME
+        self.legacy = self.log_dir / analytics.LEGACY_LOG_FILE_NAME
+
+        self.now = datetime(2025, 3, 15, 12, 0, tzinfo=timezone.utc)
+        for p in (patch.object(analytics, "S3_BUCKET", None),
+                  patch.object(analytics, "_last_prune_day", None),
+                  patch.object(analytics, "_now_utc", lambda: self.now)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def write_lines(self, entries):
+        with self.log_file.open("a", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e) + "\n")
+
+    def logged(self):
+        return list(analytics._iter_log(self.log_file))
+
+
+class TestLegacyMigration(AnalyticsTestCase):
+    def test_converts_and_renames_legacy_file(self):
+        entries = [visit(self.now), visit(self.now, tab="About Me", path="/about")]
+        self.legacy.write_text(json.dumps(entries, indent=2), encoding="utf-8")
+
+        self.assertEqual(analytics.load_analytics_data(self.log_dir), entries)
+        self.assertFalse(self.legacy.exists())
+        self.assertTrue((self.log_dir / "visits.json.migrated").exists())
+        self.assertEqual(self.logged(), entries)
+
+    def test_new_visits_append_after_migrated_ones(self):
+        old = visit(self.now - timedelta(hours=1))
+        self.legacy.write_text(json.dumps([old]), encoding="utf-8")
+
+        new = visit(self.now)
+        analytics._write_entry(new, self.log_dir)
+        self.assertEqual(self.logged(), [old, new])
+        self.assertFalse(self.legacy.exists())
+
+    def test_corrupt_legacy_file_starts_fresh_log(self):
+        self.legacy.write_text("[{not json", encoding="utf-8")
+        self.assertEqual(analytics.load_analytics_data(self.log_dir), [])
+        self.assertFalse(self.legacy.exists())
+        self.assertEqual((self.log_dir / "visits.json.migrated").read_text(encoding="utf-8"), "[{not json")
+
+    def test_leftover_legacy_file_is_not_merged_again(self):
+        # crash after the JSONL log was written but before the rename
+        current = visit(self.now)
+        self.write_lines([current])
+        self.legacy.write_text(json.dumps([visit(self.now - timedelta(hours=1))]), encoding="utf-8")
+
+        self.assertEqual(analytics.load_analytics_data(self.log_dir), [current])
+        self.assertFalse(self.legacy.exists())
+
+
+class TestRetention(AnalyticsTestCase):
+    def test_prunes_expired_entries_once_a_day(self):
+        expired = visit(self.now - timedelta(days=analytics.RETENTION_DAYS + 1))
+        recent = visit(self.now - timedelta(days=1))
+        self.write_lines([expired, recent])
+
+        first = visit(self.now)
+        analytics._write_entry(first, self.log_dir)
+        self.assertEqual(self.logged(), [recent, first])
+
+        # same day: no second rewrite, even if stale lines show up
+        self.write_lines([expired])
+        second = visit(self.now + timedelta(hours=1))
+        analytics._write_entry(second, self.log_dir)
+        self.assertEqual(self.logged(), [recent, first, expired, second])
+
+        self.now += timedelta(days=1)
+        third = visit(self.now)
+        analytics._write_entry(third, self.log_dir)
+        self.assertEqual(self.logged(), [recent, first, second, third])
+
+    def test_skips_torn_lines(self):
+        self.write_lines([visit(self.now)])
+        with self.log_file.open("a", encoding="utf-8") as f:
+            f.write('{"ip": "10.0.0.2", "timest\n\n')
+        self.write_lines([visit(self.now)])
+        self.assertEqual(len(analytics.load_analytics_data(self.log_dir)), 2)
+
+
+class TestSummary(AnalyticsTestCase):
+    def test_counts_recent_visits(self):
+        day1 = self.now - timedelta(days=2)
+        self.write_lines([
+            visit(day1),
+            visit(day1, ip="10.0.0.2", device="Mobile", country="Unknown", proxy=True),
+            visit(self.now, path="/about", tab="About Me"),
+            visit(self.now, path="/about", tab="About Me", country="Germany"),
+            visit(self.now - timedelta(days=analytics.RETENTION_DAYS + 1), country="France"),
+        ])
+
+        summary = analytics.summarize_analytics(self.log_dir)
+        self.assertEqual(summary["total_visits"], 4)
+        self.assertEqual(summary["by_country"], {"Netherlands": 2, "Unknown": 1, "Germany": 1})
+        self.assertEqual(summary["by_device"], {"Desktop": 3, "Mobile": 1})
+        self.assertEqual(summary["by_ip"], {"10.0.0.1": 3, "10.0.0.2": 1})
+        self.assertEqual(summary["by_day"], {"2025-03-13": 2, "2025-03-15": 2})
+        self.assertEqual(summary["by_tab"], {"Home": 2, "About Me": 2})
+        self.assertEqual(summary["unknown_country_count"], 1)
+        self.assertEqual(summary["vpn_count"], 1)
+
+    def test_non_utc_timestamp(self):
+        # the string fast path only applies to UTC stamps; others are parsed
+        ts = datetime(2025, 3, 14, 23, 30, tzinfo=timezone(timedelta(hours=2)))
+        self.write_lines([visit(ts)])
+        summary = analytics.summarize_analytics(self.log_dir)
+        self.assertEqual(summary["total_visits"], 1)
+        self.assertEqual(summary["by_day"], {"2025-03-14": 1})
+
+    def test_empty_log(self):
+        summary = analytics.summarize_analytics(self.log_dir)
+        self.assertEqual(summary["total_visits"], 0)
+        self.assertIsNone(summary["most_visited_path"])
+
+
+class TestGeoQueue(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        # a worker that is "alive" but never drains, like one stuck on a slow geo API
+        stuck_worker = MagicMock()
+        stuck_worker.is_alive.return_value = True
+        for p in (patch.object(analytics, "_geo_queue", Queue(maxsize=2)),
+                  patch.object(analytics, "_geo_worker", stuck_worker),
+                  patch.object(analytics, "_lookup_geo", side_effect=AssertionError("no lookup expected"))):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_overflow_is_written_without_geo(self):
+        entries = [visit(self.now, ip=f"10.0.0.{i}", country=None) for i in range(3)]
+        for e in entries:
+            analytics._enqueue(e, self.log_dir)
+
+        self.assertEqual(analytics._geo_queue.qsize(), 2)
+        (written,) = self.logged()
+        self.assertEqual(written["ip"], "10.0.0.2")
+        self.assertEqual(written["country"], "Unknown")
+
+    def test_shutdown_flush_writes_queued_visits(self):
+        for i in range(2):
+            analytics._enqueue(visit(self.now, ip=f"10.0.0.{i}", country=None), self.log_dir)
+        self.assertFalse(self.log_file.exists())
+
+        analytics._flush_geo_queue()
+        self.assertEqual([e["ip"] for e in self.logged()], ["10.0.0.0", "10.0.0.1"])
+        self.assertEqual({e["country"] for e in self.logged()}, {"Unknown"})
+        self.assertTrue(analytics._geo_queue.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
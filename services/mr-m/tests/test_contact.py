@@ -0,0 +1,241 @@
+import asyncio
+import sys
+import threading
+import types
+import unittest
+from unittest.mock import patch
+
+from libs import contact
+
+
+class TestContactRateLimit(unittest.TestCase):
+    def setUp(self):
+        contact._buckets.clear()
+        contact._sweep_counter = 0
+        self.now = 1_000_000.0
+        clock = patch("libs.contact.time.time", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def spend_all(self, ip):
+        for _ in range(contact._MAX_PER_WINDOW):
+            self.assertTrue(contact._take_token(ip))
+
+    def test_burst_up_to_capacity_then_blocked(self):
+        self.spend_all("1.1.1.1")
+        self.assertFalse(contact._take_token("1.1.1.1"))
+        # other IPs have their own bucket
+        self.assertTrue(contact._take_token("2.2.2.2"))
+
+    def test_denied_take_spends_nothing(self):
+        self.spend_all("1.1.1.1")
+        for _ in range(3):
+            self.assertFalse(contact._take_token("1.1.1.1"))
+        # one interval later exactly one token is back, not less
+        self.now += contact._WINDOW_SECONDS / contact._MAX_PER_WINDOW * 1.01
+        self.assertTrue(contact._take_token("1.1.1.1"))
+
+    def test_refund_returns_the_token(self):
+        self.spend_all("1.1.1.1")
+        contact._refund("1.1.1.1")
+        self.assertTrue(contact._take_token("1.1.1.1"))
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+    def test_refund_is_capped_at_capacity(self):
+        contact._refund("1.1.1.1")
+        self.spend_all("1.1.1.1")
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+    def test_refills_one_token_per_interval(self):
+        self.spend_all("1.1.1.1")
+        start = self.now
+        interval = contact._WINDOW_SECONDS / contact._MAX_PER_WINDOW
+
+        self.now = start + interval * 0.9
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+        self.now = start + interval * 1.01
+        self.assertTrue(contact._take_token("1.1.1.1"))
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+    def test_refill_is_capped_at_capacity(self):
+        self.spend_all("1.1.1.1")
+        self.now += contact._WINDOW_SECONDS * 10
+        self.spend_all("1.1.1.1")
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+    def test_concurrent_takes_never_exceed_capacity(self):
+        threads_n = 32
+        barrier = threading.Barrier(threads_n)
+        results = []
+
+        def submit():
+            barrier.wait()
+            results.append(contact._take_token("1.1.1.1"))
+
+        threads = [threading.Thread(target=submit) for _ in range(threads_n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.count(True), contact._MAX_PER_WINDOW)
+
+    def test_sweep_drops_only_idle_buckets(self):
+        contact._take_token("idle")
+        self.now += contact._WINDOW_SECONDS + 1
+
+        contact._sweep_counter = contact._SWEEP_EVERY - 2
+        contact._take_token("active")
+        self.assertIn("idle", contact._buckets)
+
+        contact._take_token("active")  # every _SWEEP_EVERY-th call sweeps
+        self.assertNotIn("idle", contact._buckets)
+        self.assertIn("active", contact._buckets)
+
+    def test_swept_bucket_behaves_like_a_full_one(self):
+        self.spend_all("1.1.1.1")
+        self.now += contact._WINDOW_SECONDS + 1
+        with contact._buckets_lock:
+            contact._sweep(self.now)
+        self.assertNotIn("1.1.1.1", contact._buckets)
+        self.spend_all("1.1.1.1")
+        self.assertFalse(contact._take_token("1.1.1.1"))
+
+
+class TestSendContactEmail(unittest.TestCase):
+    CFG = {"host": "smtp.example.com", "port": 587, "use_tls": True,
+           "user": "bot@example.com", "password": "pw", "recipient": "me@example.com"}
+
+    def setUp(self):
+        contact._buckets.clear()
+        for p in (patch.object(contact, "_get_smtp_config", lambda: dict(self.CFG)),
+                  patch.object(contact, "_smtp_executor", None)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def send(self, **overrides):
+        fields = {"name": "Ada", "email": "ada@example.com", "message": "Hello", "ip": "1.1.1.1"}
+        fields.update(overrides)
+        return contact.send_contact_email(**fields)
+
+    def test_failed_send_refunds_the_token(self):
+        with patch.object(contact, "_smtp_send", side_effect=OSError("down")):
+            for _ in range(contact._MAX_PER_WINDOW + 2):
+                self.assertEqual(self.send(), contact._SEND_FAILED)
+        with patch.object(contact, "_smtp_send") as smtp_send:
+            for _ in range(contact._MAX_PER_WINDOW):
+                self.assertEqual(self.send(), {"ok": True})
+            self.assertFalse(self.send()["ok"])
+        self.assertEqual(smtp_send.call_count, contact._MAX_PER_WINDOW)
+
+    def test_invalid_input_costs_nothing(self):
+        for _ in range(contact._MAX_PER_WINDOW + 2):
+            self.assertFalse(self.send(email="")["ok"])
+        self.assertNotIn("1.1.1.1", contact._buckets)
+
+    def test_concurrent_submissions_are_limited(self):
+        threads_n = 16
+        barrier = threading.Barrier(threads_n)
+        results = []
+
+        def submit():
+            barrier.wait()
+            results.append(self.send()["ok"])
+
+        with patch.object(contact, "_smtp_send"):
+            threads = [threading.Thread(target=submit) for _ in range(threads_n)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(results.count(True), contact._MAX_PER_WINDOW)
+
+
+class FakeAsyncSMTP:
+    """Stand-in for aiosmtplib.SMTP that records what a send would have done."""
+
+    instances = []
+    fail_with = None
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.logged_in = None
+        self.sent = []
+        FakeAsyncSMTP.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def login(self, user, password):
+        self.logged_in = (user, password)
+
+    async def send_message(self, msg):
+        if FakeAsyncSMTP.fail_with is not None:
+            raise FakeAsyncSMTP.fail_with
+        self.sent.append(msg)
+
+
+class TestSendContactEmailAsync(unittest.TestCase):
+    CFG = {"host": "smtp.example.com", "port": 587, "use_tls": True,
+           "user": "bot@example.com", "password": "pw", "recipient": "me@example.com"}
+
+    def setUp(self):
+        contact._buckets.clear()
+        FakeAsyncSMTP.instances = []
+        FakeAsyncSMTP.fail_with = None
+        self.config_threads = []
+
+        def get_config():
+            self.config_threads.append(threading.current_thread())
+            return dict(self.CFG)
+
+        fake_module = types.ModuleType("aiosmtplib")
+        fake_module.SMTP = FakeAsyncSMTP
+        for p in (patch.dict(sys.modules, {"aiosmtplib": fake_module}),
+                  patch.object(contact, "_get_smtp_config", get_config)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def send(self, **overrides):
+        fields = {"name": "Ada", "email": "ada@example.com", "message": "Hello", "ip": "1.1.1.1"}
+        fields.update(overrides)
+        return asyncio.run(contact.send_contact_email_async(**fields))
+
+    def test_sends_and_spends_a_token(self):
+        self.assertEqual(self.send(), {"ok": True})
+
+        (server,) = FakeAsyncSMTP.instances
+        self.assertEqual(server.kwargs["hostname"], "smtp.example.com")
+        self.assertTrue(server.kwargs["start_tls"])
+        self.assertFalse(server.kwargs["use_tls"])
+        self.assertEqual(server.logged_in, ("bot@example.com", "pw"))
+        (msg,) = server.sent
+        self.assertEqual(msg["To"], "me@example.com")
+        self.assertEqual(msg["Reply-To"], "ada@example.com")
+        self.assertIn("Hello", msg.get_content())
+        self.assertIn("1.1.1.1", contact._buckets)
+
+    def test_blocking_checks_run_off_the_event_loop(self):
+        self.send()
+        self.assertEqual(len(self.config_threads), 1)
+        self.assertIsNot(self.config_threads[0], threading.main_thread())
+
+    def test_send_failure_reports_error(self):
+        FakeAsyncSMTP.fail_with = OSError("connection refused")
+        self.assertEqual(self.send(), contact._SEND_FAILED)
+
+    def test_invalid_input_never_connects(self):
+        response = self.send(message="  ")
+        self.assertFalse(response["ok"])
+        self.assertEqual(FakeAsyncSMTP.instances, [])
+
+    def test_honeypot_pretends_success(self):
+        self.assertEqual(self.send(honeypot="bot"), {"ok": True})
+        self.assertEqual(FakeAsyncSMTP.instances, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import sys
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+import generate_embedding_knowledge as gen  # noqa: E402
+
+
+class FakeMinHash:
+    """Keeps the exact shingle set, so the fake LSH below can compute true Jaccard."""
+
+    def __init__(self, num_perm=128):
+        self.shingles = set()
+
+    def update(self, value):
+        self.shingles.add(value)
+
+
+class FakeMinHashLSH:
+    def __init__(self, threshold=0.5, num_perm=128):
+        self.threshold = threshold
+        self.entries = {}
+
+    def insert(self, key, mh):
+        if key in self.entries:
+            raise ValueError(f"duplicate key {key}")
+        self.entries[key] = mh.shingles
+
+    def query(self, mh):
+        return [k for k, s in self.entries.items()
+                if len(s & mh.shingles) / len(s | mh.shingles) >= self.threshold]
+
+
+WORDS = " ".join(f"word{i}" for i in range(60))
+
+
+def chunk(chunk_id, text, source="page.html"):
+    return {"id": chunk_id.split("_")[0], "chunk_id": chunk_id, "title": "T", "source_path": source, "text": text}
+
+
+class TestCollectPending(unittest.TestCase):
+    def setUp(self):
+        for p in (patch.object(gen, "MinHash", FakeMinHash), patch.object(gen, "MinHashLSH", FakeMinHashLSH)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def embedded(self, chunks):
+        """Digests of chunks from an earlier run, as load_existing_hashes returns them."""
+        seen = set()
+        gen.collect_pending(chunks, seen)
+        return seen
+
+    def test_edited_chunk_is_reembedded(self):
+        old = chunk("doc_1", WORDS)
+        edited = chunk("doc_1", WORDS + " one more sentence")
+        seen = self.embedded([old])
+
+        pending = gen.collect_pending([edited], seen)
+        self.assertEqual([p["text"] for p in pending], [edited["text"]])
+        self.assertEqual(pending[0]["text_hash"], gen.get_text_hash(pending[0]["embedding_input"]))
+
+    def test_unchanged_chunk_is_skipped(self):
+        seen = self.embedded([chunk("doc_1", WORDS)])
+        self.assertEqual(gen.collect_pending([chunk("doc_1", WORDS)], seen), [])
+
+    def test_near_duplicates_within_a_run_are_skipped(self):
+        pending = gen.collect_pending([
+            chunk("a_1", WORDS, source="a.html"),
+            chunk("b_1", WORDS + " footer", source="b.html"),
+            chunk("c_1", "something else entirely, with other words", source="c.html"),
+        ], set())
+        self.assertEqual([p["chunk_id"] for p in pending], ["a_1", "c_1"])
+
+    def test_exact_duplicates_are_skipped(self):
+        pending = gen.collect_pending([chunk("a_1", WORDS), chunk("a_1", WORDS)], set())
+        self.assertEqual(len(pending), 1)
+
+    def test_near_dup_check_can_be_disabled(self):
+        pending = gen.collect_pending([
+            chunk("a_1", WORDS, source="a.html"),
+            chunk("b_1", WORDS + " footer", source="b.html"),
+        ], set(), near_dups=False)
+        self.assertEqual(len(pending), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import unittest
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch
+
+from libs import ratelimiter
+
+try:
+    import fakeredis  # needs the [lua] extra to run the increment script
+except ImportError:
+    fakeredis = None
+
+
+class _ClockMixin:
+    """Drive the limiter's clock (time.time and datetime.now) from self.now."""
+
+    def start_clock(self, now: datetime):
+        self.now = now
+        test = self
+
+        class FakeDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return test.now
+
+        for target, new in (("libs.ratelimiter.datetime", FakeDatetime),
+                            ("libs.ratelimiter.time.time", lambda: test.now.timestamp())):
+            p = patch(target, new)
+            p.start()
+            self.addCleanup(p.stop)
+
+        ratelimiter._today_cache = (-1, "")
+        ratelimiter._ttl_cache = (-1, 0)
+
+    def advance(self, **delta):
+        self.now += timedelta(**delta)
+
+
+class TestMemoryBackend(_ClockMixin, unittest.TestCase):
+    def setUp(self):
+        self.start_clock(datetime(2025, 3, 1, 23, 0, tzinfo=timezone.utc))
+        ratelimiter._mem.clear()
+        for p in (patch.object(ratelimiter, "TABLE_NAME", None),
+                  patch.object(ratelimiter, "_get_redis", return_value=None)):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_allows_up_to_limit_then_denies(self):
+        for _ in range(ratelimiter.RATE_LIMIT):
+            self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertFalse(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertTrue(ratelimiter.check_and_increment_ip("2.2.2.2"))
+
+    def test_quota(self):
+        self.assertEqual(ratelimiter.get_ip_quota("1.1.1.1")["used"], 0)
+        ratelimiter.check_and_increment_ip("1.1.1.1")
+        quota = ratelimiter.get_ip_quota("1.1.1.1")
+        self.assertEqual(quota["used"], 1)
+        self.assertEqual(quota["remaining"], ratelimiter.RATE_LIMIT - 1)
+        # one hour to midnight plus the 5 minute buffer
+        self.assertEqual(quota["reset_in_seconds"], 3600 + 300)
+
+    def test_day_rollover_resets(self):
+        for _ in range(ratelimiter.RATE_LIMIT + 1):
+            ratelimiter.check_and_increment_ip("1.1.1.1")
+        self.assertFalse(ratelimiter.check_and_increment_ip("1.1.1.1"))
+
+        self.advance(hours=2)
+        self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertEqual(ratelimiter.get_ip_quota("1.1.1.1")["used"], 1)
+
+
+@unittest.skipUnless(fakeredis is not None, "fakeredis[lua] not installed")
+class TestRedisBackend(_ClockMixin, unittest.TestCase):
+    def setUp(self):
+        self.start_clock(datetime(2025, 3, 1, 23, 0, tzinfo=timezone.utc))
+        self.server = fakeredis.FakeServer()
+        for p in (patch.object(ratelimiter, "TABLE_NAME", None),
+                  patch.object(ratelimiter, "_r", None),
+                  patch.object(ratelimiter, "_incr_script", None),
+                  patch.dict(os.environ, {"REDIS_HOST": "localhost"}),
+                  patch("redis.Redis", lambda **kw: fakeredis.FakeRedis(server=self.server, **kw))):
+            p.start()
+            self.addCleanup(p.stop)
+        ratelimiter._mem.clear()
+        self.r = ratelimiter._get_redis()
+
+    def test_increments_one_hash_field_per_ip(self):
+        for _ in range(ratelimiter.RATE_LIMIT):
+            self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertFalse(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        ratelimiter.check_and_increment_ip("2.2.2.2")
+
+        key = "ratelimit:v3:2025-03-01"
+        self.assertEqual(self.r.hgetall(key), {"1.1.1.1": str(ratelimiter.RATE_LIMIT + 1), "2.2.2.2": "1"})
+        self.assertEqual(ratelimiter._mem, {})
+
+    def test_expiry_armed_once_until_midnight(self):
+        key = "ratelimit:v3:2025-03-01"
+        ratelimiter.check_and_increment_ip("1.1.1.1")
+        self.assertAlmostEqual(self.r.ttl(key), 3600 + 300, delta=2)
+
+        # later increments leave an existing expiry alone...
+        self.r.expire(key, 100)
+        ratelimiter.check_and_increment_ip("1.1.1.1")
+        self.assertAlmostEqual(self.r.ttl(key), 100, delta=2)
+
+        # ...but re-arm one that was lost
+        self.r.persist(key)
+        ratelimiter.check_and_increment_ip("1.1.1.1")
+        self.assertAlmostEqual(self.r.ttl(key), 3600 + 300, delta=2)
+
+    def test_quota(self):
+        for _ in range(2):
+            ratelimiter.check_and_increment_ip("1.1.1.1")
+        quota = ratelimiter.get_ip_quota("1.1.1.1")
+        self.assertEqual(quota["used"], 2)
+        self.assertEqual(quota["remaining"], ratelimiter.RATE_LIMIT - 2)
+        self.assertAlmostEqual(quota["reset_in_seconds"], 3600 + 300, delta=2)
+        self.assertEqual(ratelimiter.get_ip_quota("9.9.9.9")["used"], 0)
+
+    def test_day_rollover_uses_new_hash(self):
+        for _ in range(ratelimiter.RATE_LIMIT + 1):
+            ratelimiter.check_and_increment_ip("1.1.1.1")
+
+        self.advance(hours=2)
+        self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertEqual(self.r.hget("ratelimit:v3:2025-03-02", "1.1.1.1"), "1")
+        self.assertEqual(ratelimiter.get_ip_quota("1.1.1.1")["used"], 1)
+
+    def test_carries_over_count_from_per_ip_key(self):
+        # counter written by the previous deploy, before the day hash
+        legacy = "ratelimit:v3:2025-03-01:1.1.1.1"
+        self.r.set(legacy, ratelimiter.RATE_LIMIT - 1, ex=3600)
+        self.assertEqual(ratelimiter.get_ip_quota("1.1.1.1")["used"], ratelimiter.RATE_LIMIT - 1)
+
+        self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertFalse(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertEqual(self.r.hget("ratelimit:v3:2025-03-01", "1.1.1.1"), str(ratelimiter.RATE_LIMIT + 1))
+        self.assertFalse(self.r.exists(legacy))
+        self.assertEqual(ratelimiter.get_ip_quota("1.1.1.1")["used"], ratelimiter.RATE_LIMIT + 1)
+
+    def test_falls_back_to_memory_on_redis_error(self):
+        with patch.object(ratelimiter, "_incr_script", side_effect=ConnectionError("down")), \
+                self.assertLogs("libs.ratelimiter", level="WARNING"):
+            self.assertTrue(ratelimiter.check_and_increment_ip("1.1.1.1"))
+        self.assertEqual(ratelimiter._mem[ratelimiter._get_ip_key("1.1.1.1")]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import pickle
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import faiss
+import numpy as np
+import pyarrow as pa
+
+from libs import search
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+import generate_embedding_knowledge  # noqa: E402
+
+
+class WordEncoding:
+    """Stand-in for the tiktoken encoding: one token per whitespace-separated word."""
+
+    def encode(self, text):
+        return text.split()
+
+    def encode_batch(self, texts):
+        return [self.encode(t) for t in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def reference_rag_query(history, current_message, max_tokens):
+    """The accumulate-and-break selection build_rag_query used before the prefix sum."""
+    encoding = WordEncoding()
+    current_tokens = encoding.encode(current_message)
+    remaining_tokens = max_tokens - len(current_tokens)
+    if remaining_tokens < 0:
+        return encoding.decode(current_tokens[:max_tokens]).strip()
+
+    user_messages = [m["content"] for m in reversed(history) if m.get("role") == "user"]
+    total_tokens = 0
+    selected = []
+    for msg in user_messages:
+        token_count = len(encoding.encode(msg))
+        if total_tokens + token_count > remaining_tokens:
+            break
+        selected.insert(0, msg)
+        total_tokens += token_count
+
+    selected.append(current_message)
+    return " ".join(selected).strip()
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+class TestBuildRagQuery(unittest.TestCase):
+    def setUp(self):
+        p = patch.object(search, "_encoding", WordEncoding)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def check(self, history, message, max_tokens):
+        expected = reference_rag_query(history, message, max_tokens)
+        self.assertEqual(search.build_rag_query(history, message, max_tokens=max_tokens), expected)
+        return expected
+
+    def test_empty_history(self):
+        self.assertEqual(self.check([], "what now", 10), "what now")
+
+    def test_no_user_turns(self):
+        history = [{"role": "assistant", "content": "hello there"}]
+        self.assertEqual(self.check(history, "what now", 10), "what now")
+
+    def test_everything_fits_in_chronological_order(self):
+        history = [user("one"), {"role": "assistant", "content": "reply"}, user("two two")]
+        self.assertEqual(self.check(history, "three", 10), "one two two three")
+
+    def test_exact_budget_is_included(self):
+        history = [user("a a"), user("b b b")]
+        # 2 + 3 history tokens + 1 current token == 6
+        self.assertEqual(self.check(history, "q", 6), "a a b b b q")
+
+    def test_one_token_over_budget_drops_oldest(self):
+        history = [user("a a"), user("b b b")]
+        self.assertEqual(self.check(history, "q", 5), "b b b q")
+
+    def test_stops_at_first_message_that_does_not_fit(self):
+        # newest-first: "c" fits, "b b b b" doesn't, so the older "a" is not used either
+        history = [user("a"), user("b b b b"), user("c")]
+        self.assertEqual(self.check(history, "q", 4), "c q")
+
+    def test_current_message_fills_budget(self):
+        self.assertEqual(self.check([user("a")], "q q q", 3), "q q q")
+
+    def test_current_message_over_budget_is_truncated(self):
+        self.assertEqual(self.check([user("a")], "q w e r", 2), "q w")
+
+    def test_matches_reference_on_many_histories(self):
+        for n in range(6):
+            history = [user(" ".join([f"m{i}"] * (i % 4 + 1))) for i in range(n)]
+            for max_tokens in range(0, 14):
+                with self.subTest(n=n, max_tokens=max_tokens):
+                    self.check(history, "q", max_tokens)
+
+
+class TestQueryIndex(unittest.TestCase):
+    """Hits are merged across queries, deduped, and padded/out-of-range ids dropped."""
+
+    def setUp(self):
+        # four orthogonal unit vectors: the inner product with a query is its own component
+        self.index = faiss.IndexFlatIP(4)
+        self.index.add(np.eye(4, dtype="float32"))
+        self.columns = search.to_columns(
+            [{"source_path": f"doc{i}", "text": f"text{i}"} for i in range(4)])
+        self.queries = {}
+        p = patch.object(search, "embed_query",
+                         lambda q: np.array([self.queries[q]], dtype="float32"))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def query(self, questions, top_k, columns=None):
+        hits = search.query_index(questions, self.index, columns or self.columns, top_k=top_k)
+        return [source for source, _ in hits]
+
+    def test_single_query_ranked(self):
+        self.queries["a"] = [0.1, 0.0, 0.9, 0.4]
+        self.assertEqual(self.query("a", 2), ["doc2", "doc3"])
+
+    def test_pairs_source_with_text(self):
+        self.queries["a"] = [0.0, 1.0, 0.0, 0.0]
+        self.assertEqual(search.query_index("a", self.index, self.columns, top_k=1), [("doc1", "text1")])
+
+    def test_fewer_vectors_than_top_k(self):
+        small = faiss.IndexFlatIP(4)
+        small.add(np.eye(4, dtype="float32")[:2])
+        self.queries["a"] = [1.0, 0.5, 0.0, 0.0]
+        hits = search.query_index("a", small, self.columns, top_k=5)
+        self.assertEqual([s for s, _ in hits], ["doc0", "doc1"])
+
+    def test_multi_query_dedups_and_ranks_by_score(self):
+        self.queries["a"] = [1.0, 0.9, 0.0, 0.0]  # normalized: doc0 .74, doc1 .67
+        self.queries["b"] = [0.0, 1.0, 0.5, 0.0]  # normalized: doc1 .89, doc2 .45
+        self.assertEqual(self.query(["a", "b"], 2), ["doc1", "doc0"])
+        self.assertEqual(self.query(["a", "b"], 3), ["doc1", "doc0", "doc2"])
+
+    def test_multi_query_fewer_results_than_top_k(self):
+        small = faiss.IndexFlatIP(4)
+        small.add(np.eye(4, dtype="float32")[:2])
+        self.queries["a"] = [1.0, 0.2, 0.0, 0.0]
+        self.queries["b"] = [0.3, 1.0, 0.0, 0.0]
+        hits = search.query_index(["a", "b"], small, self.columns, top_k=5)
+        self.assertEqual([s for s, _ in hits], ["doc0", "doc1"])
+
+    def test_ids_past_metadata_are_dropped(self):
+        short = search.to_columns([{"source_path": "doc0", "text": "text0"}])
+        self.queries["a"] = [0.2, 1.0, 0.0, 0.0]
+        self.assertEqual(self.query("a", 2, columns=short), ["doc0"])
+        self.queries["b"] = [0.0, 0.0, 1.0, 0.0]
+        self.assertEqual(self.query(["a", "b"], 3, columns=short), ["doc0"])
+
+    def test_empty_question_list(self):
+        self.assertEqual(self.query([], 3), [])
+
+    def test_arrow_columns(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            metadata_path = Path(tmp) / "metadata.pkl"
+            table = pa.table({"source_path": [f"doc{i}" for i in range(4)],
+                              "text": [f"text{i}" for i in range(4)]})
+            with pa.OSFile(str(metadata_path.with_suffix(".arrow")), "wb") as sink, \
+                    pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+            columns = search.load_columns(metadata_path)
+            for column in columns.values():
+                self.assertIsInstance(column, pa.ChunkedArray)
+            self.queries["a"] = [1.0, 0.9, 0.0, 0.0]
+            self.queries["b"] = [0.0, 1.0, 0.5, 0.0]
+            self.assertEqual(self.query(["a", "b"], 3, columns=columns), ["doc1", "doc0", "doc2"])
+            self.assertEqual(self.query("a", 9, columns=columns)[:2], ["doc0", "doc1"])
+
+
+class TestLoadColumns(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.metadata_path = Path(tmp.name) / "metadata.pkl"
+        self.metadata = [{"source_path": f"doc{i}", "text": f"text{i}", "title": "t"} for i in range(3)]
+        with self.metadata_path.open("wb") as f:
+            pickle.dump(self.metadata, f)
+
+    def test_memory_maps_arrow_file_written_by_the_embedding_script(self):
+        write = generate_embedding_knowledge._arrow_columns_to(self.metadata)
+        write(self.metadata_path.with_suffix(".arrow"))
+
+        with patch.object(search, "load_metadata", side_effect=AssertionError("pickle should not be read")):
+            columns = search.load_columns(self.metadata_path)
+        self.assertIsInstance(columns["text"], pa.ChunkedArray)
+        self.assertIsInstance(columns["source_path"], pa.ChunkedArray)
+        self.assertEqual(columns["text"].to_pylist(), ["text0", "text1", "text2"])
+        self.assertEqual(columns["source_path"].to_pylist(), ["doc0", "doc1", "doc2"])
+
+    def test_falls_back_to_pickle_without_arrow_file(self):
+        columns = search.load_columns(self.metadata_path)
+        self.assertIsInstance(columns["text"], np.ndarray)
+        self.assertEqual(columns["text"].tolist(), ["text0", "text1", "text2"])
+
+
+if __name__ == "__main__":
+    unittest.main()